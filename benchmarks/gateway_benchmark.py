@@ -0,0 +1,206 @@
+"""Benchmark of the bot's gateway profile: RSS and event handling CPU on a simulated event stream.
+
+Feeds the same synthetic stream of gateway events (a large guild, then guild messages, presence
+and member updates, typing events and a few DMs) through discord.py's event parsers, once with
+the original configuration (all intents, default caches) and once with the bot's lean one.
+The gateway only sends the events a client subscribed to, so each profile only gets the events
+its intents cover. Each profile runs in its own process so their RSS does not mix.
+
+Usage: python benchmarks/gateway_benchmark.py [--events N] [--members N] [--samples N]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import discord
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import main  # noqa: E402
+
+GUILD_ID: int = 1000
+GUILD_CHANNEL_ID: int = 1001
+DM_CHANNEL_ID: int = 2001
+TIMESTAMP: str = "2024-01-01T00:00:00+00:00"
+# Share of each event type in the stream, with the intent that subscribes to it
+EVENT_MIX: list[tuple[str, str, float]] = [
+    ("MESSAGE_CREATE", "guild_messages", 0.60),
+    ("PRESENCE_UPDATE", "presences", 0.25),
+    ("TYPING_START", "guild_typing", 0.10),
+    ("GUILD_MEMBER_UPDATE", "members", 0.04),
+    ("DM_MESSAGE_CREATE", "dm_messages", 0.01),
+]
+
+
+def user(uid: int) -> dict:
+    return {"id": str(uid), "username": f"user{uid}", "discriminator": "0", "avatar": None, "global_name": None}
+
+
+def member(uid: int) -> dict:
+    return {"user": user(uid), "roles": [], "joined_at": TIMESTAMP, "deaf": False, "mute": False, "flags": 0}
+
+
+def presence(uid: int) -> dict:
+    return {
+        "user": {"id": str(uid)},
+        "guild_id": str(GUILD_ID),
+        "status": random.choice(["online", "idle", "dnd"]),
+        "activities": [{"name": "a game", "type": 0, "created_at": 0}],
+        "client_status": {"desktop": "online"},
+    }
+
+
+def message(mid: int, uid: int, guild: bool) -> dict:
+    data = {
+        "id": str(mid),
+        "channel_id": str(GUILD_CHANNEL_ID if guild else DM_CHANNEL_ID),
+        "author": user(uid),
+        "content": "some chat message " * random.randint(1, 10),
+        "timestamp": TIMESTAMP,
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+    }
+    if guild:
+        data["guild_id"] = str(GUILD_ID)
+        data["member"] = {"roles": [], "joined_at": TIMESTAMP, "deaf": False, "mute": False, "flags": 0}
+    return data
+
+
+def guild(members: int, intents: discord.Intents) -> dict:
+    # Member lists and presences are only sent to clients with the matching intents
+    uids = range(10_000, 10_000 + members)
+    return {
+        "id": str(GUILD_ID),
+        "name": "benchmark",
+        "owner_id": "10000",
+        "member_count": members,
+        "large": True,
+        "features": [],
+        "emojis": [],
+        "stickers": [],
+        "roles": [
+            {
+                "id": str(GUILD_ID),
+                "name": "@everyone",
+                "permissions": "0",
+                "position": 0,
+                "color": 0,
+                "hoist": False,
+                "managed": False,
+                "mentionable": False,
+            }
+        ],
+        "channels": [{"id": str(GUILD_CHANNEL_ID), "type": 0, "name": "general", "position": 0, "permission_overwrites": []}],
+        "members": [member(uid) for uid in uids] if intents.members else [],
+        "presences": [presence(uid) for uid in uids] if intents.presences else [],
+        "threads": [],
+        "voice_states": [],
+        "stage_instances": [],
+        "guild_scheduled_events": [],
+    }
+
+
+def make_event(kind: str, i: int, members: int) -> dict:
+    uid = 10_000 + random.randrange(members)
+    if kind == "MESSAGE_CREATE":
+        return message(i, uid, guild=True)
+    if kind == "PRESENCE_UPDATE":
+        return presence(uid)
+    if kind == "TYPING_START":
+        return {"channel_id": str(GUILD_CHANNEL_ID), "guild_id": str(GUILD_ID), "user_id": str(uid), "timestamp": 0, "member": member(uid)}
+    if kind == "GUILD_MEMBER_UPDATE":
+        return {"guild_id": str(GUILD_ID), **member(uid), "nick": f"nick{i}"}
+    return message(i, 1, guild=False)
+
+
+class BenchmarkClient(discord.Client):
+    async def on_message(self, message: discord.Message):
+        pass
+
+
+def make_client(profile: str) -> discord.Client:
+    if profile == "full":
+        # The original configuration
+        return BenchmarkClient(intents=discord.Intents.all(), chunk_guilds_at_startup=False)
+    return BenchmarkClient(
+        intents=main.BOT_INTENTS,
+        max_messages=None,
+        member_cache_flags=discord.MemberCacheFlags.none(),
+        chunk_guilds_at_startup=False,
+    )
+
+
+async def run_profile(profile: str, events: int, members: int, samples: int) -> list[dict]:
+    random.seed(0)
+    process = psutil.Process()
+    results: list[dict] = []
+    kinds = [kind for kind, _, _ in EVENT_MIX]
+    weights = [weight for _, _, weight in EVENT_MIX]
+    delivered = 0
+    cpu = 0.0  # Spent in discord.py handling events, not generating them
+    async with make_client(profile) as client:
+        state = client._connection
+        intents = client.intents
+        data = guild(members, intents)
+        start = time.process_time()
+        state.parsers["GUILD_CREATE"](data)
+        cpu += time.process_time() - start
+        for i in range(1, events + 1):
+            kind = random.choices(kinds, weights)[0]
+            intent = next(intent for k, intent, _ in EVENT_MIX if k == kind)
+            data = make_event(kind, i, members)
+            start = time.process_time()
+            if getattr(intents, intent):
+                state.parsers["MESSAGE_CREATE" if kind == "DM_MESSAGE_CREATE" else kind](data)
+                delivered += 1
+            if i % 100 == 0:
+                # Let the dispatched event handlers run
+                await asyncio.sleep(0)
+            cpu += time.process_time() - start
+            if i % (events // samples) == 0:
+                results.append({"events": i, "delivered": delivered, "cpu": cpu, "rss": process.memory_info().rss})
+    return results
+
+
+def run_in_subprocess(profile: str, args: argparse.Namespace) -> list[dict]:
+    command = [sys.executable, __file__, "--profile", profile, "--events", str(args.events), "--members", str(args.members)]
+    command += ["--samples", str(args.samples)]
+    return json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout)
+
+
+def main_benchmark(args: argparse.Namespace):
+    runs = {profile: run_in_subprocess(profile, args) for profile in ["full", "lean"]}
+    print(f"{args.events} events, guild with {args.members} members")
+    print(f"{'events':>8} | {'full: delivered':>15} {'CPU (s)':>8} {'RSS (MiB)':>10} | {'lean: delivered':>15} {'CPU (s)':>8} {'RSS (MiB)':>10}")
+    for full, lean in zip(runs["full"], runs["lean"]):
+        print(
+            f"{full['events']:>8} | {full['delivered']:>15} {full['cpu']:>8.2f} {full['rss'] / 2**20:>10.1f} | "
+            f"{lean['delivered']:>15} {lean['cpu']:>8.2f} {lean['rss'] / 2**20:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=100_000, help="Events in the simulated stream")
+    parser.add_argument("--members", type=int, default=5_000, help="Members of the simulated guild")
+    parser.add_argument("--samples", type=int, default=10, help="Measurements taken along the stream")
+    parser.add_argument("--profile", choices=["full", "lean"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.profile:
+        print(json.dumps(asyncio.run(run_profile(args.profile, args.events, args.members, args.samples))))
+    else:
+        main_benchmark(args)
@@ -0,0 +1,272 @@
+"""Offline load test of the bot's hot paths against a fake Discord.
+
+Drives on_message, /shell (shell_session) and InteractiveShellView with scripted workloads. Stand-ins for
+the discord.py channel, message and interaction objects count every API call and answer it after a
+simulated latency, so no bot token or network access is needed.
+
+Workloads:
+    dm-flood        1000 DM commands from 10 users, all sent at once
+    big-output      one interactive session printing 50 MB
+    many-sessions   30 concurrent interactive sessions printing 200000 lines each
+    progress-bars   one interactive session redrawing a progress bar 200000 times
+
+For dm-flood, latency is the time to handle each message (p50/p99). For the session workloads it is the
+event loop lag measured while they run, which is what every other command waits for. Each workload
+runs in its own process, so the peak RSS reported is its own. Interactive sessions need bash, and
+run with HOME set to an empty directory so that slow shell startup files do not skew the results.
+
+Usage: python benchmarks/load_benchmark.py [--workload NAME ...] [--api-latency SECONDS] [--scale FACTOR]
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional
+
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import main  # noqa: E402
+
+WORKLOADS: list[str] = ["dm-flood", "big-output", "many-sessions", "progress-bars"]
+PROGRESS_BAR_SCRIPT: str = """import sys
+n = int(sys.argv[1])
+for i in range(n + 1):
+    done = 40 * i // n
+    sys.stdout.write(f"\\r\\x1b[32m[{'#' * done}{' ' * (40 - done)}]\\x1b[0m {100 * i // n:3d}% ({i}/{n})")
+    sys.stdout.flush()
+sys.stdout.write("\\n")
+"""
+
+
+class FakeAPI:
+    """Counts the Discord API calls made through the fakes and answers each after `latency` seconds."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency: float = latency
+        self.calls: collections.Counter = collections.Counter()
+
+    async def call(self, kind: str):
+        self.calls[kind] += 1
+        await asyncio.sleep(self.latency)
+
+
+class FakeUser:
+    def __init__(self, uid: int) -> None:
+        self.id: int = uid
+        self.name: str = f"user{uid}"
+        self.bot: bool = False
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeMessage:
+    def __init__(self, api: FakeAPI, channel: "FakeChannel", content: str = "", author: Optional[FakeUser] = None, id: int = 0) -> None:
+        self.api: FakeAPI = api
+        self.channel: FakeChannel = channel
+        self.content: str = content
+        self.author: Optional[FakeUser] = author
+        self.id: int = id
+
+    async def edit(self, **kwargs):
+        await self.api.call("message_edit")
+
+
+class FakeChannel:
+    def __init__(self, api: FakeAPI) -> None:
+        self.api: FakeAPI = api
+
+    async def send(self, content: str = "", **kwargs) -> FakeMessage:
+        await self.api.call("channel_send")
+        return FakeMessage(self.api, self, content)
+
+    def typing(self):
+        return contextlib.nullcontext()
+
+
+class FakeResponse:
+    def __init__(self, api: FakeAPI) -> None:
+        self.api: FakeAPI = api
+        self.done: bool = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def defer(self, **kwargs):
+        self.done = True
+        await self.api.call("interaction_defer")
+
+    async def send_message(self, content: str = "", **kwargs):
+        self.done = True
+        await self.api.call("interaction_send")
+
+
+class FakeFollowup:
+    def __init__(self, api: FakeAPI) -> None:
+        self.api: FakeAPI = api
+
+    async def send(self, content: str = "", **kwargs):
+        await self.api.call("followup_send")
+
+
+class FakeInteraction:
+    def __init__(self, api: FakeAPI, user: FakeUser, id: int) -> None:
+        self.api: FakeAPI = api
+        self.user: FakeUser = user
+        self.id: int = id
+        self.response: FakeResponse = FakeResponse(api)
+        self.followup: FakeFollowup = FakeFollowup(api)
+        self.view = None
+        self.edits: int = 0
+
+    async def edit_original_response(self, view=None, **kwargs):
+        self.view = view
+        self.edits += 1
+        await self.api.call("interaction_edit")
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss() -> int:
+    try:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return psutil.Process().memory_info().rss
+
+
+async def dm_flood(api: FakeAPI, scale: float) -> dict:
+    count = max(1, int(1000 * scale))
+    users = [FakeUser(100 + i) for i in range(10)]
+    main.WHITELIST = [user.id for user in users]
+    main.EXECUTOR.max_queue_size = count  # Measure throughput, not queue rejections
+    channel = FakeChannel(api)
+    latencies: list[float] = []
+
+    async def send(i: int):
+        message = FakeMessage(api, channel, f"echo message {i}", users[i % len(users)], i)
+        start = time.monotonic()
+        await main.on_message(message)  # type: ignore[arg-type]
+        latencies.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    await asyncio.gather(*(send(i) for i in range(count)))
+    elapsed = time.monotonic() - start
+    return {
+        "seconds": elapsed,
+        "throughput": f"{count / elapsed:.1f} cmd/s",
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "renders": api.calls["message_edit"],
+        "coalesced": None,  # Streamed command output is throttled, not coalesced
+    }
+
+
+async def run_session(api: FakeAPI, user: FakeUser, id: int, command: str) -> tuple[FakeInteraction, main.ShellSession]:
+    interaction = FakeInteraction(api, user, id)
+    await main.shell_session.callback(interaction, "bash")  # type: ignore[arg-type]
+    session = next(session for session in main.SESSIONS.sessions.values() if session.view is interaction.view)
+    await session.view.write_input(f"{command}; exit\n".encode())
+    while session.id in main.SESSIONS.sessions:
+        await asyncio.sleep(0.05)
+    return interaction, session
+
+
+async def sessions_workload(api: FakeAPI, commands: list[str]) -> dict:
+    user = FakeUser(100)
+    main.WHITELIST = [user.id]
+    main.NOTIFIER.channels[user.id] = FakeChannel(api)  # type: ignore[assignment]
+    main.LOOP_MONITOR.start()
+    start = time.monotonic()
+    results = await asyncio.gather(*(run_session(api, user, i, command) for i, command in enumerate(commands)))
+    elapsed = time.monotonic() - start
+    output = sum(session.bytes_total for _, session in results)
+    # No lag sample yet if the workload finished within the first LOOP_LAG_INTERVAL
+    lag = next((h for (name, _), h in main.METRICS.histograms.items() if name == "event_loop_lag_seconds"), None)
+    return {
+        "seconds": elapsed,
+        "throughput": f"{output / elapsed / 2**20:.1f} MiB/s",
+        "p50": lag.quantile(0.5) if lag else 0.0,
+        "p99": lag.quantile(0.99) if lag else 0.0,
+        "renders": sum(interaction.edits for interaction, _ in results),
+        "coalesced": sum(session.view.renderer.edits_dropped for _, session in results),
+    }
+
+
+async def run_workload(name: str, api_latency: float, scale: float) -> dict:
+    api = FakeAPI(api_latency)
+    if name == "dm-flood":
+        result = await dm_flood(api, scale)
+    elif name == "big-output":
+        size = int(50 * 2**20 * scale)
+        line = "the quick brown fox jumps over the lazy dog 0123456789 " * 2
+        result = await sessions_workload(api, [f"yes '{line.strip()}' | head -c {size}"])
+    elif name == "many-sessions":
+        result = await sessions_workload(api, [f"seq 1 {int(200_000 * scale)}"] * 30)
+    else:
+        path = os.path.join(main.SESSIONS_PATH, "progress_bar.py")
+        with open(path, "w") as file:
+            file.write(PROGRESS_BAR_SCRIPT)
+        result = await sessions_workload(api, [f"{sys.executable} {path} {int(200_000 * scale)}"])
+    result["api_calls"] = sum(api.calls.values())
+    result["peak_rss"] = peak_rss()
+    return result
+
+
+def run_in_subprocess(name: str, args: argparse.Namespace) -> dict:
+    command = [sys.executable, __file__, "--run", name, "--api-latency", str(args.api_latency), "--scale", str(args.scale)]
+    return json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout)
+
+
+def main_benchmark(args: argparse.Namespace):
+    print(f"Simulated Discord API latency: {args.api_latency * 1000:.0f} ms, scale: {args.scale}")
+    print(
+        f"{'workload':<14} {'seconds':>8} {'throughput':>14} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'renders':>8} {'coalesced':>10} {'API calls':>10} {'peak RSS':>10}"
+    )
+    for name in args.workload:
+        result = run_in_subprocess(name, args)
+        coalesced = "-" if result["coalesced"] is None else result["coalesced"]
+        print(
+            f"{name:<14} {result['seconds']:>8.2f} {result['throughput']:>14} {result['p50'] * 1000:>8.1f} "
+            f"{result['p99'] * 1000:>8.1f} {result['renders']:>8} {coalesced:>10} {result['api_calls']:>10} "
+            f"{main.format_bytes(result['peak_rss']):>10}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", nargs="+", choices=WORKLOADS, default=WORKLOADS, help="Workloads to run")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Seconds each fake Discord API call takes")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for the size of every workload")
+    parser.add_argument("--run", choices=WORKLOADS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        logging.basicConfig(level=logging.WARNING)
+        main.CMD_TIMEOUT = 60.0
+        main.SCROLL_AMOUNT = main.DEFAULT_SCROLL_AMOUNT
+        main.STREAM_OUTPUT = main.DEFAULT_STREAM_OUTPUT
+        main.COMPACT_OUTPUT = main.DEFAULT_COMPACT_OUTPUT
+        main.LOOP_MONITOR.threshold = 0  # No watchdog thread
+        with tempfile.TemporaryDirectory() as sessions_path:
+            main.SESSIONS_PATH = sessions_path
+            os.environ["HOME"] = sessions_path
+            print(json.dumps(asyncio.run(run_workload(args.run, args.api_latency, args.scale))))
+    else:
+        main_benchmark(args)
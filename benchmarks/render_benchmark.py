@@ -0,0 +1,110 @@
+"""Micro-benchmark of InteractiveShellView.build_log_message against log size.
+
+Compares the original implementation (the whole log kept in a string, the window chosen by
+re-measuring the message on every line) with the current LogBuffer based one.
+
+Usage: python benchmarks/render_benchmark.py [--repeat N]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import main  # noqa: E402
+
+LOG_SIZES: list[int] = [1_000, 10_000, 100_000, 1_000_000]
+MAX_CONTENT_SIZE: int = 4000
+
+
+def legacy_build_log_message(log: str, log_window_base: int) -> str:
+    # The original algorithm, minus the locks and window base updates
+    prefix = "```sh\n"
+    header = ""
+    body = ""
+    footer = ""
+    suffix = "\n```"
+    if log.strip() == "":
+        return prefix + " " + suffix
+    lines = log.splitlines()
+    for i in range(len(lines)):
+        lines[i] = lines[i].rstrip() + "\n"
+    body = "".join(lines)
+    content = prefix + header + body + footer + suffix
+    if len(content) <= MAX_CONTENT_SIZE:
+        return content
+    body = ""
+    if log_window_base < 0:
+        header = "…\n"
+        for i in range(len(lines) - 1, -1, -1):
+            free = MAX_CONTENT_SIZE - len(prefix + header + body + footer + suffix)
+            if free >= len(lines[i]):
+                body = lines[i] + body
+            else:
+                break
+    else:
+        if log_window_base != 0:
+            header = "…\n"
+        for i in range(log_window_base, len(lines)):
+            free = MAX_CONTENT_SIZE - len(prefix + header + body + footer + suffix)
+            if free == len(lines[i]):
+                body += lines[i]
+                break
+            elif free > len(lines[i]):
+                body += lines[i]
+            else:
+                body += lines[i][: free - 1]
+                footer = "…"
+                break
+    return prefix + header + body + footer + suffix
+
+
+def make_log(n_lines: int) -> str:
+    return "".join(f"{i:>8} some output of a long running command {'#' * (i % 40)}\n" for i in range(n_lines))
+
+
+def measure(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+async def build_current(view: main.InteractiveShellView, base: int) -> str:
+    view.log_window_base = base
+    return await view.build_log_message()
+
+
+async def measure_async(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+async def run(repeat: int):
+    print(f"{'lines':>10} {'mode':>7} {'legacy (ms)':>12} {'current (ms)':>13} {'speedup':>8}")
+    for n_lines in LOG_SIZES:
+        log = make_log(n_lines)
+        view = main.InteractiveShellView(None)  # type: ignore[arg-type]
+        view.log = main.LogBuffer(max_lines=n_lines)
+        view.log.append(log)
+        for mode, base in [("tail", main.WINDOW_BASE_AUTO_SCROLL_ENABLE), ("scroll", n_lines // 2)]:
+            assert legacy_build_log_message(log, base) == await build_current(view, base)
+            legacy = measure(lambda: legacy_build_log_message(log, base), repeat)
+            current = await measure_async(lambda: build_current(view, base), repeat)
+            print(f"{n_lines:>10} {mode:>7} {legacy * 1000:>12.3f} {current * 1000:>13.3f} {legacy / current:>7.0f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (the best one is reported)")
+    args = parser.parse_args()
+    asyncio.run(run(args.repeat))
@@ -1,21 +1,53 @@
 from dotenv import load_dotenv
 from asyncio import sleep, Lock
 import asyncio
-from discord import ui, ButtonStyle, Intents, Message, Client, app_commands, File, Interaction, TextStyle, User, Member, SelectOption
-from typing import Optional, Union
+from discord import ui, ButtonStyle, Intents, MemberCacheFlags, Message, Client, app_commands, File, Interaction, TextStyle, User, Member, SelectOption, DMChannel, HTTPException
+from typing import Awaitable, Callable, Optional, Union
 import subprocess
-from os import path, getenv, makedirs, remove
-from logging.handlers import TimedRotatingFileHandler
+from os import path, getenv, makedirs
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+from datetime import datetime, timezone
 import logging
-from requests import get, Response
+import queue
+import atexit
+import threading
+import traceback
+import contextlib
+import aiohttp
+from aiohttp import web
 import signal
 import sys
 import os
-import shlex
-import shutil
 import re
+import shutil
+import json
+import hmac
+import hashlib
+import ipaddress
+import io
+import zlib
+import mmap
+import uuid
+from array import array
+import codecs
+import difflib
+import itertools
+import collections.abc
+from bisect import bisect_left, bisect_right
+import time
 import psutil
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+if sys.platform != "win32":
+    import fcntl
+    import pty
+    import resource
+    import termios
+
 # -----------------------Initiate all global variables--------------------------
 
 
@@ -23,21 +55,71 @@ class BotClient(Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.tree = app_commands.CommandTree(self)
+        self.start_time: float = time.monotonic()
+        self.started: bool = False
+        # Every Discord API call, including the time spent waiting for rate limits
+        self.http_request = self.http.request
+        self.http.request = self.timed_http_request
+
+    async def timed_http_request(self, route, **kwargs):
+        with METRICS.timer("discord_api_seconds", route=f"{route.method} {route.path}"):
+            return await self.http_request(route, **kwargs)
+
+    async def setup_hook(self):
+        # Runs once, right after login and before connecting to the gateway
+        logging.info(f"Startup: logged in after {time.monotonic() - self.start_time:.2f}s")
+        sync_start = time.monotonic()
+        try:
+            synced = await sync_command_tree(self.tree)
+        except (HTTPException, app_commands.AppCommandError) as e:
+            # The hash is only stored after a successful sync, so the next start tries again
+            logging.error(f"Startup: command tree sync failed: {e}")
+            return
+        if synced:
+            logging.info(f"Startup: command tree synced in {time.monotonic() - sync_start:.2f}s")
+        else:
+            logging.info("Startup: command tree unchanged, sync skipped")
 
     async def on_ready(self):
-        await self.tree.sync()
-        print(f"Finished setup. Logged in as {self.user}")
-        self.loop.create_task(loop())
-
-
-BOT: BotClient = BotClient(intents=Intents.all())
+        # Also fired after every gateway reconnect
+        if self.started:
+            logging.info("Reconnected to Discord")
+            return
+        self.started = True
+        rss = format_bytes(psutil.Process().memory_info().rss)
+        logging.info(f"Startup: ready after {time.monotonic() - self.start_time:.2f}s, RSS {rss}")
+        print(f"Finished setup. Logged in as {self.user} (RSS {rss})")
+        IP_MONITOR.start()
+        STATS.start()
+        SHELL_POOL.start()
+        LOOP_MONITOR.start()
+        if METRICS_PORT:
+            try:
+                await METRICS.serve(METRICS_PORT)
+            except OSError as e:
+                logging.error(f"Unable to serve metrics on port {METRICS_PORT}: {e}")
+
+
+# Commands arrive as DMs and slash command interactions, so nothing else is subscribed to or cached.
+# DM message content does not need the privileged message content intent.
+BOT_INTENTS: Intents = Intents.none()
+BOT_INTENTS.guilds = True
+BOT_INTENTS.dm_messages = True
+BOT: BotClient = BotClient(
+    intents=BOT_INTENTS,
+    max_messages=None,
+    member_cache_flags=MemberCacheFlags.none(),
+    chunk_guilds_at_startup=False,
+)
 
 # Path constants
 PROJECT_PATH: str = path.dirname(path.realpath(__file__))
 DATA_PATH: str = path.join(PROJECT_PATH, "data")
 LOG_PATH: str = path.join(DATA_PATH, "main.log")
+AUDIT_LOG_PATH: str = path.join(DATA_PATH, "audit.jsonl")
 PUBLIC_IP_PATH: str = path.join(DATA_PATH, "public_ip.txt")
-TEMP_PATH: str = path.join(DATA_PATH, "temp")
+SESSIONS_PATH: str = path.join(DATA_PATH, "sessions")
+COMMAND_TREE_HASH_PATH: str = path.join(DATA_PATH, "command_tree.sha256")
 
 # Environment constants
 TOKEN: str = ""
@@ -46,6 +128,40 @@ SUPPORTED_SHELLS: list[str] = ["sh", "bash", "zsh", "powershell", "cmd"]
 DEFAULT_CMD_TIMEOUT: float = 5.0
 DEFAULT_SCROLL_AMOUNT: int = 5
 DEFAULT_SHELL: str = "bash"
+DEFAULT_CMD_WORKERS: int = 4
+DEFAULT_CMD_QUEUE_SIZE: int = 10
+DEFAULT_STREAM_OUTPUT: bool = True
+DEFAULT_COMPACT_OUTPUT: bool = False
+OUTPUT_HISTORY_SIZE: int = 20
+LOG_MAX_LINES: int = 10000
+LOG_SPILL: bool = True
+LOG_SPILL_MAX_SIZE: int = 256 * 1024 * 1024
+RENDER_FPS: float = 1.0
+RENDER_BUDGET: float = 5.0
+SHELL_POOL_SIZE: int = 0
+SHELL_POOL_MAX_IDLE: float = 60 * 60
+IP_PROVIDERS: list[str] = ["https://api.ipify.org/?format=json", "https://ifconfig.me/ip", "https://icanhazip.com"]
+IP_CHECK_INTERVAL: float = 60 * 60
+IP_CHECK_TIMEOUT: float = 10.0
+ATTACHMENT_COMPRESSION: str = "gzip"
+ATTACHMENT_COMPRESS_THRESHOLD: int = 1024 * 1024
+MAX_UPLOAD_SIZE: int = 10 * 1024 * 1024
+AGENT_SECRET: str = ""
+AGENT_LISTEN: tuple[str, int] = ("127.0.0.1", 8765)
+AGENT_HOSTS: dict[str, tuple[str, int]] = {}
+METRICS_PORT: int = 0
+WATCHDOG_THRESHOLD: float = 1.0
+EXEC_NICE: int = 10
+EXEC_IONICE: str = "best-effort:7"
+EXEC_RLIMITS: dict[str, int] = {}
+EXEC_CGROUP: str = ""
+EXEC_CGROUP_CPU_PERCENT: int = 0
+EXEC_CGROUP_MEMORY_MAX: int = 0
+STATS_INTERVAL: float = 10.0
+STATS_HISTORY: float = 6 * 60 * 60
+STATS_DISK_PATH: str = path.abspath(os.sep)
+STATS_ALERTS: dict[str, float] = {"cpu": 90.0, "memory": 90.0, "disk": 95.0}
+DEFAULT_STATS_MINUTES: int = 15
 DEFAULT_SIGNAL: int
 if sys.platform == "win32":
     DEFAULT_SIGNAL = signal.CTRL_C_EVENT
@@ -53,16 +169,65 @@ else:
     DEFAULT_SIGNAL = signal.SIGINT
 
 # Global variables
+AUDIT_LOGGER: logging.Logger = logging.getLogger("audit")
 CMD_TIMEOUT: float
 SCROLL_AMOUNT: int
+STREAM_OUTPUT: bool
+COMPACT_OUTPUT: bool
 
 # Magic numbers
 WINDOW_BASE_AUTO_SCROLL_ENABLE: int = -1
 WINDOW_BASE_AUTO_SCROLL_DISABLE: int = -2
-
-# Strip ANSI CSI (colors, cursor moves, bracketed paste on/off) and OSC (title changes)
-ANSI_CSI_RE = re.compile(r"(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~]")
-ANSI_OSC_RE = re.compile(r"\x1B\][^\x07\x1B]*(?:\x07|\x1B\\)")
+IP_RETRY_DELAY: float = 60.0  # First retry after a failed public IP check, doubled on each failure
+IP_FAILURES_BEFORE_ALERT: int = 3
+NOTIFY_BATCH_DELAY: float = 2.0  # Alerts for the same user within this many seconds are sent as one message
+NOTIFY_CONCURRENCY: int = 5
+NOTIFY_RETRIES: int = 3
+MAX_MESSAGE_SIZE: int = 2000
+STREAM_EDIT_INTERVAL: float = 1.0  # Discord allows about 5 edits per 5 seconds per channel
+STREAM_TAIL_LINES: int = MAX_MESSAGE_SIZE  # Enough lines to fill a message even if they are all empty
+OUTPUT_COLLAPSE_MIN_RUN: int = 3  # Identical consecutive lines shown as one line with a count
+OUTPUT_DIFF_CONTEXT: int = 1  # Unchanged lines shown around each change
+OUTPUT_DIFF_MAX_LINES: int = 10000  # Longer outputs are not diffed, difflib gets slow
+OUTPUT_HISTORY_MAX_SIZE: int = 1024 * 1024  # Longer outputs are not kept for the next diff
+MAX_READ_SIZE: int = 256 * 1024
+ATTACHMENT_CHUNK_SIZE: int = 1024 * 1024  # Bytes encoded and compressed at a time when building attachments
+LOG_SPILL_INDEX_STRIDE: int = 64  # Spilled lines per index entry
+LOG_SEARCH_CHUNK_LINES: int = 4096  # Lines joined per regex scan when indexing a search
+LOG_SEARCH_CHUNK_SIZE: int = 1024 * 1024  # Bytes of the spill file decoded per regex scan
+SESSION_QUANTUM: int = 64 * 1024  # Bytes of output processed per session before moving on to the next one
+SESSION_INBOX_LIMIT: int = 4 * 1024 * 1024  # Unprocessed output per session before reading is paused
+FINISHED_SESSION_SPILLS: int = 5  # Ended sessions whose spilled log stays on disk for Export
+AGENT_CONNECT_TIMEOUT: float = 10.0  # Also the extra time given to an agent to answer after the command timeout
+AGENT_MAX_FRAME: int = 64 * 1024 * 1024
+AGENT_AUTH_MAX_FRAME: int = 4096  # Frames exchanged before the peer has authenticated
+AGENT_MAC_SIZE: int = 32  # HMAC-SHA256 appended to every frame after the handshake
+LOCAL_HOST_NAME: str = "local"  # Host name of the bot's own machine in /fanout
+LOOP_LAG_INTERVAL: float = 0.5  # Seconds between event loop lag measurements (and watchdog checks)
+# Resource limits that can be set through EXEC_RLIMITS, by name
+EXEC_RLIMIT_NAMES: list[str] = ["cpu", "as", "nofile", "nproc"]
+EXEC_SIZE_UNITS: dict[str, int] = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+CGROUP_CPU_PERIOD: int = 100000  # Microseconds, the kernel's default cpu.max period
+STATS_ALERT_SAMPLES: int = 3  # Samples in a row above a threshold before alerting
+STATS_SPARKLINE_WIDTH: int = 24
+SPARKLINE_CHARS: str = "▁▂▃▄▅▆▇█"
+# Histogram bucket upper bounds, in seconds
+METRICS_BUCKETS: list[float] = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Escape sequences that do not change the text: CSI other than erase-line and horizontal cursor moves
+# (colors, modes, bracketed paste), OSC (title changes), other ESC sequences, and BEL
+TERMINAL_IGNORED_RE = re.compile(
+    r"(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-BE-FH-JL-~]"
+    r"|\x1B\][^\x07\x1B]*(?:\x07|\x1B\\)"
+    r"|\x1B[ -/]*[0-Z\\^-~]"
+    r"|\x07"
+)
+# What is left: plain text, line controls and the CSI sequences that edit the current line.
+# A lone ESC/CSI byte is a malformed sequence.
+TERMINAL_TOKEN_RE = re.compile(r"[^\x1B\x9B\r\x08]+|\r|\x08|(?:\x1B\[|\x9B)([0-?]*)[ -/]*([@-~])|[\x1B\x9B]")
+# An escape sequence cut at the end of a chunk
+TERMINAL_INCOMPLETE_RE = re.compile(r"(?:\x1B(?:\[[0-?]*[ -/]*|\][^\x07\x1B]*\x1B?|[ -/]*)|\x9B[0-?]*[ -/]*)\Z")
+TERMINAL_MAX_PENDING: int = 4096
 
 # ---------------------------------Functions------------------------------------
 
@@ -127,10 +292,335 @@ def load_default_shell() -> None:
         DEFAULT_SHELL = env.strip()
 
 
-def load_environ():
+def load_cmd_workers() -> None:
+    global DEFAULT_CMD_WORKERS
+    env: Optional[str] = getenv("CMD_WORKERS")
+    if env is not None:
+        try:
+            DEFAULT_CMD_WORKERS = max(1, int(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid CMD_WORKERS value: {env}")
+    EXECUTOR.max_workers = DEFAULT_CMD_WORKERS
+
+
+def load_cmd_queue_size() -> None:
+    global DEFAULT_CMD_QUEUE_SIZE
+    env: Optional[str] = getenv("CMD_QUEUE_SIZE")
+    if env is not None:
+        try:
+            DEFAULT_CMD_QUEUE_SIZE = max(1, int(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid CMD_QUEUE_SIZE value: {env}")
+    EXECUTOR.max_queue_size = DEFAULT_CMD_QUEUE_SIZE
+
+
+def load_default_stream_output() -> None:
+    global DEFAULT_STREAM_OUTPUT, STREAM_OUTPUT
+    env: Optional[str] = getenv("DEFAULT_STREAM_OUTPUT")
+    if env is not None:
+        try:
+            DEFAULT_STREAM_OUTPUT = parse_bool(env)
+        except ValueError:
+            logging.error(f"Invalid DEFAULT_STREAM_OUTPUT value: {env}")
+    STREAM_OUTPUT = DEFAULT_STREAM_OUTPUT
+
+
+def load_compact_output() -> None:
+    global DEFAULT_COMPACT_OUTPUT, COMPACT_OUTPUT, OUTPUT_HISTORY_SIZE
+    env: Optional[str] = getenv("DEFAULT_COMPACT_OUTPUT")
+    if env is not None:
+        try:
+            DEFAULT_COMPACT_OUTPUT = parse_bool(env)
+        except ValueError:
+            logging.error(f"Invalid DEFAULT_COMPACT_OUTPUT value: {env}")
+    COMPACT_OUTPUT = DEFAULT_COMPACT_OUTPUT
+    env = getenv("OUTPUT_HISTORY_SIZE")
+    if env is not None:
+        try:
+            OUTPUT_HISTORY_SIZE = max(1, int(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid OUTPUT_HISTORY_SIZE value: {env}")
+    OUTPUT_HISTORY.max_entries = OUTPUT_HISTORY_SIZE
+
+
+def load_log_max_lines() -> None:
+    global LOG_MAX_LINES, LOG_SPILL, LOG_SPILL_MAX_SIZE
+    env: Optional[str] = getenv("LOG_MAX_LINES")
+    if env is not None:
+        try:
+            LOG_MAX_LINES = max(1, int(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid LOG_MAX_LINES value: {env}")
+    env = getenv("LOG_SPILL")
+    if env is not None:
+        try:
+            LOG_SPILL = parse_bool(env)
+        except ValueError:
+            logging.error(f"Invalid LOG_SPILL value: {env}")
+    env = getenv("LOG_SPILL_MAX_SIZE")
+    if env is not None:
+        try:
+            LOG_SPILL_MAX_SIZE = max(1, parse_size(env))
+        except ValueError:
+            logging.error(f"Invalid LOG_SPILL_MAX_SIZE value: {env}")
+
+
+def load_render_fps() -> None:
+    global RENDER_FPS
+    env: Optional[str] = getenv("RENDER_FPS")
+    if env is not None:
+        try:
+            value = float(env.strip())
+            if value <= 0:
+                raise ValueError
+            RENDER_FPS = value
+        except ValueError:
+            logging.error(f"Invalid RENDER_FPS value: {env}")
+
+
+def load_render_budget() -> None:
+    global RENDER_BUDGET
+    env: Optional[str] = getenv("RENDER_BUDGET")
+    if env is not None:
+        try:
+            value = float(env.strip())
+            if value <= 0:
+                raise ValueError
+            RENDER_BUDGET = value
+        except ValueError:
+            logging.error(f"Invalid RENDER_BUDGET value: {env}")
+    SESSIONS.render_budget = RENDER_BUDGET
+
+
+def load_shell_pool() -> None:
+    global SHELL_POOL_SIZE, SHELL_POOL_MAX_IDLE
+    env: Optional[str] = getenv("SHELL_POOL_SIZE")
+    if env is not None:
+        try:
+            SHELL_POOL_SIZE = max(0, int(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid SHELL_POOL_SIZE value: {env}")
+    env = getenv("SHELL_POOL_MAX_IDLE")
+    if env is not None:
+        try:
+            SHELL_POOL_MAX_IDLE = max(1.0, float(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid SHELL_POOL_MAX_IDLE value: {env}")
+    SHELL_POOL.size = SHELL_POOL_SIZE
+    SHELL_POOL.max_idle = SHELL_POOL_MAX_IDLE
+
+
+def load_ip_monitor() -> None:
+    global IP_PROVIDERS, IP_CHECK_INTERVAL, IP_CHECK_TIMEOUT
+    env: Optional[str] = getenv("IP_PROVIDERS")
+    if env is not None:
+        IP_PROVIDERS = [url.strip() for url in env.split(",") if url.strip()]
+    env = getenv("IP_CHECK_INTERVAL")
+    if env is not None:
+        try:
+            IP_CHECK_INTERVAL = max(1.0, float(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid IP_CHECK_INTERVAL value: {env}")
+    env = getenv("IP_CHECK_TIMEOUT")
+    if env is not None:
+        try:
+            IP_CHECK_TIMEOUT = max(0.1, float(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid IP_CHECK_TIMEOUT value: {env}")
+    IP_MONITOR.providers = IP_PROVIDERS
+    IP_MONITOR.interval = IP_CHECK_INTERVAL
+    IP_MONITOR.timeout = IP_CHECK_TIMEOUT
+
+
+def load_attachment_settings() -> None:
+    global ATTACHMENT_COMPRESSION, ATTACHMENT_COMPRESS_THRESHOLD, MAX_UPLOAD_SIZE
+    env: Optional[str] = getenv("ATTACHMENT_COMPRESSION")
+    if env is not None:
+        value = env.strip().lower()
+        if value not in ["none", "gzip", "zstd"]:
+            logging.error(f"Invalid ATTACHMENT_COMPRESSION value: {env}")
+        elif value == "zstd" and zstandard is None:
+            logging.error("ATTACHMENT_COMPRESSION is zstd but the zstandard package is not installed. Using gzip.")
+            ATTACHMENT_COMPRESSION = "gzip"
+        else:
+            ATTACHMENT_COMPRESSION = value
+    env = getenv("ATTACHMENT_COMPRESS_THRESHOLD")
+    if env is not None:
+        try:
+            ATTACHMENT_COMPRESS_THRESHOLD = max(0, int(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid ATTACHMENT_COMPRESS_THRESHOLD value: {env}")
+    env = getenv("MAX_UPLOAD_SIZE")
+    if env is not None:
+        try:
+            MAX_UPLOAD_SIZE = max(1024, int(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid MAX_UPLOAD_SIZE value: {env}")
+
+
+def parse_bool(value: str) -> bool:
+    value = value.strip().lower()
+    if value in ["1", "true", "yes", "on"]:
+        return True
+    if value in ["0", "false", "no", "off"]:
+        return False
+    raise ValueError(f"Invalid boolean: {value}")
+
+
+def parse_host_port(value: str) -> tuple[str, int]:
+    # "host:port", with IPv6 addresses in brackets ("[::1]:8765")
+    host, sep, port = value.strip().rpartition(":")
+    if not sep or not host:
+        raise ValueError(f"Missing host or port: {value}")
+    return host.strip("[]"), int(port)
+
+
+def load_agent_settings() -> None:
+    global AGENT_SECRET, AGENT_LISTEN, AGENT_HOSTS
+    env: Optional[str] = getenv("AGENT_SECRET")
+    if env is not None:
+        AGENT_SECRET = env.strip()
+    env = getenv("AGENT_LISTEN")
+    if env is not None:
+        try:
+            AGENT_LISTEN = parse_host_port(env)
+        except ValueError:
+            logging.error(f"Invalid AGENT_LISTEN value: {env}")
+    env = getenv("AGENT_HOSTS")
+    if env is not None:
+        hosts: dict[str, tuple[str, int]] = {}
+        for entry in env.split(","):
+            if not entry.strip():
+                continue
+            name, sep, address = entry.partition("=")
+            try:
+                if not sep or not name.strip() or name.strip() == LOCAL_HOST_NAME:
+                    raise ValueError(f"Invalid host name: {name}")
+                hosts[name.strip()] = parse_host_port(address)
+            except ValueError:
+                logging.error(f"Invalid AGENT_HOSTS entry: {entry}")
+        AGENT_HOSTS = hosts
+    AGENTS.hosts = AGENT_HOSTS
+
+
+def load_metrics_settings() -> None:
+    global METRICS_PORT, WATCHDOG_THRESHOLD
+    env: Optional[str] = getenv("METRICS_PORT")
+    if env is not None:
+        try:
+            METRICS_PORT = int(env.strip())
+            if not 0 <= METRICS_PORT <= 65535:
+                raise ValueError
+        except ValueError:
+            METRICS_PORT = 0
+            logging.error(f"Invalid METRICS_PORT value: {env}")
+    env = getenv("WATCHDOG_THRESHOLD")
+    if env is not None:
+        try:
+            WATCHDOG_THRESHOLD = max(0.0, float(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid WATCHDOG_THRESHOLD value: {env}")
+    LOOP_MONITOR.threshold = WATCHDOG_THRESHOLD
+
+
+def parse_size(value: str) -> int:
+    # Byte counts with an optional K, M, G or T suffix (powers of 1024), e.g. "512M"
+    match = re.fullmatch(r"(\d+)\s*([kmgt]?)i?b?", value.strip().lower())
+    if match is None:
+        raise ValueError(f"Invalid size: {value}")
+    return int(match.group(1)) * EXEC_SIZE_UNITS[match.group(2)]
+
+
+def load_execution_policy() -> None:
+    global EXEC_NICE, EXEC_IONICE, EXEC_RLIMITS, EXEC_CGROUP, EXEC_CGROUP_CPU_PERCENT, EXEC_CGROUP_MEMORY_MAX
+    env: Optional[str] = getenv("EXEC_NICE")
+    if env is not None:
+        try:
+            EXEC_NICE = min(19, max(0, int(env.strip())))
+        except ValueError:
+            logging.error(f"Invalid EXEC_NICE value: {env}")
+    env = getenv("EXEC_IONICE")
+    if env is not None:
+        value = env.strip().lower()
+        io_class, _, level = value.partition(":")
+        if value in ["", "none", "idle"] or (io_class == "best-effort" and level in [str(n) for n in range(8)]):
+            EXEC_IONICE = value or "none"
+        else:
+            logging.error(f"Invalid EXEC_IONICE value: {env}")
+    env = getenv("EXEC_RLIMITS")
+    if env is not None:
+        limits: dict[str, int] = {}
+        for entry in env.split(","):
+            if not entry.strip():
+                continue
+            name, sep, value = entry.partition("=")
+            name = name.strip().lower()
+            try:
+                if not sep or name not in EXEC_RLIMIT_NAMES:
+                    raise ValueError(f"Invalid limit name: {name}")
+                limits[name] = parse_size(value)
+            except ValueError:
+                logging.error(f"Invalid EXEC_RLIMITS entry: {entry}")
+        EXEC_RLIMITS = limits
+    env = getenv("EXEC_CGROUP")
+    if env is not None:
+        EXEC_CGROUP = env.strip()
+    env = getenv("EXEC_CGROUP_CPU_PERCENT")
+    if env is not None:
+        try:
+            EXEC_CGROUP_CPU_PERCENT = max(0, int(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid EXEC_CGROUP_CPU_PERCENT value: {env}")
+    env = getenv("EXEC_CGROUP_MEMORY_MAX")
+    if env is not None:
+        try:
+            EXEC_CGROUP_MEMORY_MAX = parse_size(env) if env.strip() else 0
+        except ValueError:
+            logging.error(f"Invalid EXEC_CGROUP_MEMORY_MAX value: {env}")
+    EXEC_POLICY.configure()
+
+
+def load_stats_settings() -> None:
+    global STATS_INTERVAL, STATS_HISTORY, STATS_DISK_PATH, STATS_ALERTS
+    env: Optional[str] = getenv("STATS_INTERVAL")
+    if env is not None:
+        try:
+            STATS_INTERVAL = max(0.0, float(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid STATS_INTERVAL value: {env}")
+    env = getenv("STATS_HISTORY")
+    if env is not None:
+        try:
+            STATS_HISTORY = max(60.0, float(env.strip()))
+        except ValueError:
+            logging.error(f"Invalid STATS_HISTORY value: {env}")
+    env = getenv("STATS_DISK_PATH")
+    if env is not None and env.strip():
+        STATS_DISK_PATH = env.strip()
+    env = getenv("STATS_ALERTS")
+    if env is not None:
+        alerts: dict[str, float] = {}
+        for entry in env.split(","):
+            if not entry.strip():
+                continue
+            name, sep, value = entry.partition("=")
+            name = name.strip().lower()
+            try:
+                if not sep or name not in STATS.series:
+                    raise ValueError(f"Invalid metric name: {name}")
+                alerts[name] = float(value.strip())
+            except ValueError:
+                logging.error(f"Invalid STATS_ALERTS entry: {entry}")
+        STATS_ALERTS = alerts
+    STATS.configure(STATS_INTERVAL, STATS_HISTORY)
+
+
+def load_environ(agent_mode: bool = False):
     global TOKEN, WHITELIST, SUPPORTED_SHELLS, DEFAULT_CMD_TIMEOUT, DEFAULT_SCROLL_AMOUNT, DEFAULT_SHELL
-    load_token()
-    logging.info(f"Loaded TOKEN: {TOKEN}")
+    if not agent_mode:
+        # Agents take their commands from a bot instance, not from Discord
+        load_token()
+        logging.info(f"Loaded TOKEN: {TOKEN}")
     load_whitelist()
     logging.info(f"Loaded WHITELIST: {WHITELIST}")
     load_supported_shells()
@@ -141,6 +631,43 @@ def load_environ():
     logging.info(f"Loaded DEFAULT_SCROLL_AMOUNT: {DEFAULT_SCROLL_AMOUNT}")
     load_default_shell()
     logging.info(f"Loaded DEFAULT_SHELL: {DEFAULT_SHELL}")
+    load_cmd_workers()
+    logging.info(f"Loaded CMD_WORKERS: {DEFAULT_CMD_WORKERS}")
+    load_cmd_queue_size()
+    logging.info(f"Loaded CMD_QUEUE_SIZE: {DEFAULT_CMD_QUEUE_SIZE}")
+    load_default_stream_output()
+    logging.info(f"Loaded DEFAULT_STREAM_OUTPUT: {DEFAULT_STREAM_OUTPUT}")
+    load_compact_output()
+    logging.info(f"Loaded DEFAULT_COMPACT_OUTPUT: {DEFAULT_COMPACT_OUTPUT}, OUTPUT_HISTORY_SIZE: {OUTPUT_HISTORY_SIZE}")
+    load_log_max_lines()
+    logging.info(f"Loaded LOG_MAX_LINES: {LOG_MAX_LINES}, LOG_SPILL: {LOG_SPILL}, LOG_SPILL_MAX_SIZE: {LOG_SPILL_MAX_SIZE}")
+    load_render_fps()
+    logging.info(f"Loaded RENDER_FPS: {RENDER_FPS}")
+    load_render_budget()
+    logging.info(f"Loaded RENDER_BUDGET: {RENDER_BUDGET}")
+    load_shell_pool()
+    logging.info(f"Loaded SHELL_POOL_SIZE: {SHELL_POOL_SIZE}, SHELL_POOL_MAX_IDLE: {SHELL_POOL_MAX_IDLE}")
+    load_ip_monitor()
+    logging.info(f"Loaded IP_PROVIDERS: {IP_PROVIDERS}, IP_CHECK_INTERVAL: {IP_CHECK_INTERVAL}, IP_CHECK_TIMEOUT: {IP_CHECK_TIMEOUT}")
+    load_attachment_settings()
+    logging.info(
+        f"Loaded ATTACHMENT_COMPRESSION: {ATTACHMENT_COMPRESSION}, ATTACHMENT_COMPRESS_THRESHOLD: {ATTACHMENT_COMPRESS_THRESHOLD}, "
+        f"MAX_UPLOAD_SIZE: {MAX_UPLOAD_SIZE}"
+    )
+    load_agent_settings()
+    logging.info(f"Loaded AGENT_LISTEN: {AGENT_LISTEN}, AGENT_HOSTS: {AGENT_HOSTS}, AGENT_SECRET set: {bool(AGENT_SECRET)}")
+    load_metrics_settings()
+    logging.info(f"Loaded METRICS_PORT: {METRICS_PORT}, WATCHDOG_THRESHOLD: {WATCHDOG_THRESHOLD}")
+    load_execution_policy()
+    logging.info(
+        f"Loaded EXEC_NICE: {EXEC_NICE}, EXEC_IONICE: {EXEC_IONICE}, EXEC_RLIMITS: {EXEC_RLIMITS}, EXEC_CGROUP: {EXEC_CGROUP or None}, "
+        f"EXEC_CGROUP_CPU_PERCENT: {EXEC_CGROUP_CPU_PERCENT}, EXEC_CGROUP_MEMORY_MAX: {EXEC_CGROUP_MEMORY_MAX}"
+    )
+    load_stats_settings()
+    logging.info(
+        f"Loaded STATS_INTERVAL: {STATS_INTERVAL}, STATS_HISTORY: {STATS_HISTORY}, STATS_DISK_PATH: {STATS_DISK_PATH}, "
+        f"STATS_ALERTS: {STATS_ALERTS}"
+    )
 
 
 def is_user_allowed(user: Union[User, Member]) -> bool:
@@ -166,57 +693,1505 @@ def get_signal_options(default: int = DEFAULT_SIGNAL) -> list[SelectOption]:
     return options
 
 
-def getPublicIP() -> str:
-    query_url = "https://api.ipify.org/?format=json"
-    response: Response = get(query_url)
-    if response.status_code != 200:
-        logging.error(f"Failed to get public IP address. Status code: {response.status_code}")
+def setup_logging():
+    # Records are only queued on the event loop; a listener thread does the formatting and file writes
+    log_handler = TimedRotatingFileHandler(filename=LOG_PATH, when="D", interval=30)
+    log_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%d-%b-%y %H:%M:%S"))
+    audit_handler = TimedRotatingFileHandler(filename=AUDIT_LOG_PATH, when="D", interval=30)
+    audit_handler.setFormatter(logging.Formatter("%(message)s"))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    audit_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    # The message is merged with its arguments and traceback here, the listener's formatter adds the rest
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    AUDIT_LOGGER.addHandler(QueueHandler(audit_queue))
+    AUDIT_LOGGER.setLevel(logging.INFO)
+    AUDIT_LOGGER.propagate = False
+    for listener in [QueueListener(log_queue, log_handler), QueueListener(audit_queue, audit_handler)]:
+        listener.start()
+        atexit.register(listener.stop)
+
+
+def audit(event: str, user_id: int, **fields):
+    # One JSON object per line in AUDIT_LOG_PATH
+    record = {"time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), "event": event, "user_id": user_id, **fields}
+    AUDIT_LOGGER.info(json.dumps(record))
+
+
+def audit_command(
+    user_id: int,
+    user_name: Optional[str],
+    command: str,
+    started: float,
+    result: Union[subprocess.CompletedProcess, BaseException],
+    **fields,
+):
+    record = {"user": user_name, "command": command, "duration": round(time.monotonic() - started, 3), **fields}
+    if isinstance(result, subprocess.CompletedProcess):
+        record["exit_code"] = result.returncode
+        record["output_size"] = len(result.stdout or "") + len(result.stderr or "")
+        if isinstance(result, CommandResult) and result.cpu_time is not None:
+            record["cpu_time"] = round(result.cpu_time, 3)
+        if isinstance(result, CommandResult) and result.max_rss is not None:
+            record["max_rss"] = result.max_rss
+    else:
+        record["exit_code"] = None
+        record["output_size"] = 0
+        record["error"] = str(result) or type(result).__name__
+    audit("command", user_id, **record)
+
+
+def command_tree_hash(tree: app_commands.CommandTree) -> str:
+    commands = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda c: (c["name"], c.get("type", 1)))
+    payload = json.dumps({"application_id": tree.client.application_id, "commands": commands}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def sync_command_tree(tree: app_commands.CommandTree) -> bool:
+    # Syncing is a slow, rate-limited call, so it is skipped when the commands have not changed since the last sync
+    digest = command_tree_hash(tree)
+    try:
+        with open(COMMAND_TREE_HASH_PATH, "r") as file:
+            if file.read().strip() == digest:
+                return False
+    except OSError:
+        pass
+    await tree.sync()
+    try:
+        with open(COMMAND_TREE_HASH_PATH, "w") as file:
+            file.write(digest)
+    except OSError as e:
+        logging.error(f"Unable to store the command tree hash, the next start will sync again: {e}")
+    return True
+
+
+def format_bytes(n: float) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if n < 1024 or unit == "GiB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return ""
+
+
+def format_result(result: subprocess.CompletedProcess) -> str:
+    body = f"[RETURN_CODE={result.returncode}]"
+    if result.stdout and len(result.stdout.strip()) > 0:
+        body += f"\n[OUTPUT]\n{result.stdout}"
+    if result.stderr and len(result.stderr.strip()) > 0:
+        body += f"\n[ERRORS]\n{result.stderr}"
+    return body
+
+
+def format_usage(result: subprocess.CompletedProcess) -> str:
+    if not isinstance(result, CommandResult) or result.cpu_time is None:
         return ""
-    ip = response.json()["ip"]
-    logging.info(f"Current public IP: {ip}")
-    return ip
+    usage = f"[CPU_TIME={result.cpu_time:.2f}s]"
+    if result.max_rss is not None:
+        usage += f" [MAX_RSS={format_bytes(result.max_rss)}]"
+    return usage
+
+
+def add_usage(body: str, result: subprocess.CompletedProcess) -> str:
+    # Appended to the RETURN_CODE line after compaction, as it differs between otherwise identical runs
+    usage = format_usage(result)
+    if not usage:
+        return body
+    header, sep, rest = body.partition("\n")
+    return f"{header} {usage}{sep}{rest}"
+
+
+def collapse_repeats(text: str) -> str:
+    # Shows each run of at least OUTPUT_COLLAPSE_MIN_RUN identical lines as one line with its length
+    lines: list[str] = []
+    for line, run in itertools.groupby(text.split("\n")):
+        count = sum(1 for _ in run)
+        if count >= OUTPUT_COLLAPSE_MIN_RUN:
+            lines.append(f"{line}  [×{count}]")
+        else:
+            lines.extend([line] * count)
+    return "\n".join(lines)
+
+
+def compact_output(body: str, previous: Optional[str] = None) -> str:
+    # Collapsed repeats, or only the changes since the previous output of the same command when that is shorter
+    compact = collapse_repeats(body)
+    if previous is None:
+        return compact
+    header = body.partition("\n")[0]
+    if previous == body:
+        return f"{header}\n[OUTPUT UNCHANGED SINCE LAST RUN]"
+    old_lines = previous.split("\n")
+    new_lines = body.split("\n")
+    if max(len(old_lines), len(new_lines)) > OUTPUT_DIFF_MAX_LINES:
+        return compact
+    # Without the ---/+++ file headers
+    diff = list(difflib.unified_diff(old_lines, new_lines, lineterm="", n=OUTPUT_DIFF_CONTEXT))[2:]
+    changes = f"{header}\n[CHANGES SINCE LAST RUN]\n" + collapse_repeats("\n".join(diff))
+    return changes if len(changes) < len(compact) else compact
+
+
+class Compressor:
+    """Streaming gzip or zstd compression. Every flush() makes the output so far decodable, so the number of
+    compressed bytes is known after each chunk.
+    """
+
+    def __init__(self, method: str) -> None:
+        self.method: str = method
+        if method == "zstd":
+            assert zstandard
+            self.obj = zstandard.ZstdCompressor().compressobj()
+        else:
+            self.obj = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+
+    def compress(self, data: bytes) -> bytes:
+        return self.obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK if self.method == "zstd" else zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.obj.flush()
+
+
+def line_chunks(data: Union[bytes, mmap.mmap], size: int, start: int = 0):
+    # Slices of at most size bytes from start on, cut after a newline when there is one
+    while start < len(data):
+        end = min(len(data), start + size)
+        if end < len(data):
+            newline = data.rfind(b"\n", start, end)
+            if newline > start:
+                end = newline + 1
+        yield data[start:end]
+        start = end
+
+
+def build_attachment_payloads(content: Union[str, list[Union[bytes, mmap.mmap]]], filename: str) -> list[tuple[str, bytes]]:
+    # Encodes (and above the threshold compresses) content for upload, split into numbered parts that each
+    # fit in MAX_UPLOAD_SIZE. Every part can be opened on its own, and `cat` joins them back together.
+    # Content given as byte buffers (e.g. a spill file's mmap) is streamed ATTACHMENT_CHUNK_SIZE bytes at a
+    # time, so only the compressed parts are held in memory.
+    sources = [content.encode("utf-8", errors="ignore")] if isinstance(content, str) else content
+    method = ATTACHMENT_COMPRESSION if sum(len(source) for source in sources) > ATTACHMENT_COMPRESS_THRESHOLD else "none"
+    ext = {"none": "", "gzip": ".gz", "zstd": ".zst"}[method]
+    chunk_size = max(1, min(ATTACHMENT_CHUNK_SIZE, MAX_UPLOAD_SIZE // 4))
+    parts: list[bytes] = []
+    chunks: list[bytes] = []
+    size = 0
+    compressor: Optional[Compressor] = None
+
+    def finish_part():
+        nonlocal size, compressor
+        if compressor is not None:
+            chunks.append(compressor.finish())
+        parts.append(b"".join(chunks))
+        chunks.clear()
+        size = 0
+        compressor = None
+
+    for source in sources:
+        for chunk in line_chunks(source, chunk_size):
+            # Compression can grow incompressible data slightly, so a part is cut before that could overflow it
+            if size and size + len(chunk) + len(chunk) // 64 + 64 > MAX_UPLOAD_SIZE:
+                finish_part()
+            if method == "none":
+                data = bytes(chunk)
+            else:
+                if compressor is None:
+                    compressor = Compressor(method)
+                data = compressor.compress(chunk) + compressor.flush()
+            chunks.append(data)
+            size += len(data)
+    if chunks or compressor is not None or not parts:
+        finish_part()
+    if len(parts) == 1:
+        return [(filename + ext, parts[0])]
+    stem, dot, suffix = filename.rpartition(".")
+    if not dot:
+        stem, suffix = filename, ""
+    return [(f"{stem}.part{i + 1}of{len(parts)}{dot}{suffix}{ext}", part) for i, part in enumerate(parts)]
+
+
+async def build_attachments(content: Union[str, list[Union[bytes, mmap.mmap]]], filename: str) -> list[File]:
+    # Built in memory on a worker thread: no temporary files, and compression does not block the event loop
+    with METRICS.timer("attachment_build_seconds"):
+        payloads = await asyncio.to_thread(build_attachment_payloads, content, filename)
+    return [File(io.BytesIO(payload), filename=name) for name, payload in payloads]
+
+
+def prepare_pty_shell():
+    # Runs in the child after setsid(), with the PTY slave already on fd 0
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+    EXEC_POLICY.apply()
+
+
+def parse_ip_response(text: str) -> str:
+    # Providers answer either with the bare address or with {"ip": "<address>"}
+    text = text.strip()
+    if text.startswith("{"):
+        text = str(json.loads(text)["ip"]).strip()
+    return str(ipaddress.ip_address(text))
+
+
+def sparkline(values: list[float], low: float, high: float, width: int = STATS_SPARKLINE_WIDTH) -> str:
+    # Values are averaged into at most `width` buckets, each shown as a block between `low` and `high`
+    if len(values) > width:
+        values = [
+            sum(values[i * len(values) // width : (i + 1) * len(values) // width])
+            / ((i + 1) * len(values) // width - i * len(values) // width)
+            for i in range(width)
+        ]
+    top = len(SPARKLINE_CHARS) - 1
+    if high <= low:
+        return SPARKLINE_CHARS[0] * len(values)
+    return "".join(SPARKLINE_CHARS[min(top, max(0, int((value - low) / (high - low) * top + 0.5)))] for value in values)
+
+
+def split_message(msgs: list[str], max_size: int = MAX_MESSAGE_SIZE) -> list[str]:
+    # Joins messages with newlines into as few Discord messages as possible
+    chunks: list[str] = []
+    current = ""
+    for msg in msgs:
+        msg = msg[:max_size]
+        if current and len(current) + 1 + len(msg) > max_size:
+            chunks.append(current)
+            current = ""
+        current = current + "\n" + msg if current else msg
+    if current:
+        chunks.append(current)
+    return chunks
 
 
 async def send_msg_to_user(user_id: int, msg: str, embed=None):
-    user = BOT.get_user(user_id)
-    if user != None:
-        dm_channel = user.dm_channel
-        if dm_channel == None:
-            dm_channel = await user.create_dm()
-        if embed == None:
-            await dm_channel.send(msg)
-        else:
-            await dm_channel.send(msg, embed=embed)
+    await NOTIFIER.send(user_id, msg, embed=embed)
 
 
 async def send_msg_to_all_users(msg: str, embed=None):
-    for user_id in WHITELIST:
-        await send_msg_to_user(user_id, msg, embed=embed)
+    if embed is None:
+        NOTIFIER.notify(WHITELIST, msg)
+    else:
+        await asyncio.gather(*[NOTIFIER.send(user_id, msg, embed=embed) for user_id in WHITELIST])
+
+
+# ------------------------------------Metrics-----------------------------------
+
+
+class Histogram:
+    """Observed durations in seconds, counted per METRICS_BUCKETS bucket like a Prometheus histogram."""
+
+    def __init__(self) -> None:
+        self.buckets: list[int] = [0] * (len(METRICS_BUCKETS) + 1)  # The last one is +Inf
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(METRICS_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-quantile, never more than the largest value seen
+        cumulative = 0
+        for i, count in enumerate(self.buckets):
+            cumulative += count
+            if cumulative >= q * self.count and cumulative > 0:
+                return min(METRICS_BUCKETS[i], self.max) if i < len(METRICS_BUCKETS) else self.max
+        return 0.0
+
 
+class Metrics:
+    """Histograms by name and labels, shown by /metrics and served in Prometheus text format on METRICS_PORT."""
 
-async def loop():
-    while True:
+    def __init__(self) -> None:
+        self.histograms: dict[tuple[str, tuple[tuple[str, str], ...]], Histogram] = {}
+        self.runner: Optional[web.AppRunner] = None
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: str):
+        start = time.perf_counter()
         try:
-            current_ip: str = getPublicIP()
-            stored_ip: str = ""
-            if path.exists(PUBLIC_IP_PATH):
-                with open(PUBLIC_IP_PATH, "r") as f:
-                    stored_ip = f.read().strip()
-            else:
-                stored_ip = ""
-            if current_ip == "":
-                msg: str = f"Public IP address could not be retrieved. Last known Public IP: {stored_ip}"
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self) -> str:
+        lines = [f"{'metric':<48} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            label = name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+            lines.append(
+                f"{label:<48} {histogram.count:>7} {histogram.quantile(0.5) * 1000:>9.1f} "
+                f"{histogram.quantile(0.99) * 1000:>9.1f} {histogram.max * 1000:>9.1f}"
+            )
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+            escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+            return ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped))
+
+        lines: list[str] = []
+        typed: set[str] = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            prefix = format_labels(labels) + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + [float("inf")], histogram.buckets):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            suffix = "{" + format_labels(labels) + "}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {histogram.sum}")
+            lines.append(f"{name}_count{suffix} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int):
+        # Only on localhost: scrape it from the same machine or through a tunnel
+        if self.runner is not None:
+            return
+
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.prometheus(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+        logging.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+
+METRICS: Metrics = Metrics()
+
+
+class LoopMonitor:
+    """Measures event loop lag, and from a separate thread logs the stack of whatever
+    keeps the loop blocked for longer than `threshold` seconds (0 disables the watchdog).
+    """
+
+    def __init__(self, threshold: float = WATCHDOG_THRESHOLD) -> None:
+        self.threshold: float = threshold
+        self.heartbeat: float = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self.measure_lag())
+        if self.threshold > 0:
+            threading.Thread(target=self.watchdog, name="loop-watchdog", daemon=True).start()
+
+    async def measure_lag(self):
+        while True:
+            expected = time.monotonic() + LOOP_LAG_INTERVAL
+            await sleep(LOOP_LAG_INTERVAL)
+            self.heartbeat = time.monotonic()
+            METRICS.observe("event_loop_lag_seconds", max(0.0, self.heartbeat - expected))
+
+    def watchdog(self):
+        reported = False  # Once per stall
+        while True:
+            time.sleep(LOOP_LAG_INTERVAL)
+            blocked = time.monotonic() - self.heartbeat - LOOP_LAG_INTERVAL
+            if blocked <= self.threshold:
+                reported = False
+                continue
+            if reported or self.loop_thread_id is None:
+                continue
+            reported = True
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "unavailable"
+            logging.warning(f"Event loop blocked for {blocked:.1f}s, currently running:\n{stack}")
+
+
+LOOP_MONITOR: LoopMonitor = LoopMonitor()
+
+# ----------------------------Notification Dispatcher---------------------------
+
+
+class NotificationDispatcher:
+    """Delivers bot-initiated alerts to users' DMs.
+
+    DM channels are cached, recipients are served concurrently (at most `concurrency` sends at a time),
+    transient failures are retried with backoff, and alerts queued for the same user within
+    NOTIFY_BATCH_DELAY seconds are sent together.
+    """
+
+    def __init__(self, concurrency: int = NOTIFY_CONCURRENCY, batch_delay: float = NOTIFY_BATCH_DELAY) -> None:
+        self.batch_delay: float = batch_delay
+        self.channels: dict[int, DMChannel] = {}
+        self.pending: dict[int, list[str]] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+
+    async def get_channel(self, user_id: int) -> Optional[DMChannel]:
+        channel = self.channels.get(user_id)
+        if channel is not None:
+            return channel
+        user = BOT.get_user(user_id)
+        if user is None:
+            user = await BOT.fetch_user(user_id)
+        channel = user.dm_channel
+        if channel is None:
+            channel = await user.create_dm()
+        self.channels[user_id] = channel
+        return channel
+
+    def notify(self, user_ids: list[int], msg: str):
+        for user_id in user_ids:
+            self.pending.setdefault(user_id, []).append(msg)
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await sleep(self.batch_delay)
+        self.flush_task = None
+        pending = self.pending
+        self.pending = {}
+        sends = [self.send(user_id, chunk) for user_id, msgs in pending.items() for chunk in split_message(msgs)]
+        await asyncio.gather(*sends)
+
+    async def send(self, user_id: int, msg: str, embed=None) -> bool:
+        async with self.semaphore:
+            for attempt in range(NOTIFY_RETRIES):
+                try:
+                    channel = await self.get_channel(user_id)
+                    if channel is None:
+                        return False
+                    if embed is None:
+                        await channel.send(msg)
+                    else:
+                        await channel.send(msg, embed=embed)
+                    return True
+                except HTTPException as e:
+                    if e.status < 500:
+                        # Not transient (e.g. the user does not accept DMs); discord.py already waits out 429s
+                        logging.error(f"Failed to send message to user {user_id}: {e}")
+                        return False
+                    logging.warning(f"Failed to send message to user {user_id} (attempt {attempt + 1}): {e}")
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    logging.warning(f"Failed to send message to user {user_id} (attempt {attempt + 1}): {e!r}")
+                self.channels.pop(user_id, None)
+                await sleep(2**attempt)
+            logging.error(f"Giving up sending message to user {user_id}: {msg}")
+            return False
+
+
+NOTIFIER: NotificationDispatcher = NotificationDispatcher()
+
+
+# -------------------------------Public IP Monitor------------------------------
+
+
+class PublicIPMonitor:
+    """Periodically checks the public IP address and notifies all users when it changes.
+
+    Providers are tried in order until one answers, each with a strict timeout, over one pooled HTTP
+    session. Failed checks are retried with exponential backoff, and an outage is reported once
+    (after IP_FAILURES_BEFORE_ALERT failures in a row) instead of on every check.
+    """
+
+    def __init__(self, providers: list[str] = IP_PROVIDERS, interval: float = IP_CHECK_INTERVAL, timeout: float = IP_CHECK_TIMEOUT) -> None:
+        self.providers: list[str] = providers
+        self.interval: float = interval
+        self.timeout: float = timeout
+        self.current_ip: Optional[str] = None
+        self.failures: int = 0
+        self.outage_reported: bool = False
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def load_stored_ip(self) -> str:
+        if path.exists(PUBLIC_IP_PATH):
+            with open(PUBLIC_IP_PATH, "r") as f:
+                return f.read().strip()
+        return ""
+
+    def store_ip(self, ip: str):
+        self.current_ip = ip
+        with open(PUBLIC_IP_PATH, "w") as f:
+            f.write(ip)
+
+    async def fetch_ip(self) -> str:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        for url in self.providers:
+            try:
+                async with self.session.get(url) as response:
+                    if response.status != 200:
+                        logging.warning(f"Failed to get public IP address from {url}. Status code: {response.status}")
+                        continue
+                    ip = parse_ip_response(await response.text())
+                    logging.info(f"Current public IP: {ip}")
+                    return ip
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                logging.warning(f"Failed to get public IP address from {url}: {e!r}")
+        return ""
+
+    async def check(self) -> bool:
+        if self.current_ip is None:
+            self.current_ip = self.load_stored_ip()
+        ip = await self.fetch_ip()
+        if ip == "":
+            self.failures += 1
+            if self.failures >= IP_FAILURES_BEFORE_ALERT and not self.outage_reported:
+                msg: str = f"Public IP address could not be retrieved. Last known Public IP: {self.current_ip}"
                 logging.warning(msg)
                 await send_msg_to_all_users(msg)
-            elif current_ip != stored_ip:
-                msg: str = f"Public IP address has changed from {stored_ip} to {current_ip}"
-                logging.info(msg)
-                with open(PUBLIC_IP_PATH, "w") as f:
-                    f.write(current_ip)
-                await send_msg_to_all_users(msg)
+                self.outage_reported = True
+            return False
+        if self.outage_reported:
+            logging.info("Public IP address can be retrieved again")
+        self.failures = 0
+        self.outage_reported = False
+        if ip != self.current_ip:
+            msg: str = f"Public IP address has changed from {self.current_ip} to {ip}"
+            logging.info(msg)
+            self.store_ip(ip)
+            await send_msg_to_all_users(msg)
+        return True
+
+    async def run(self):
+        while True:
+            try:
+                ok = await self.check()
+            except Exception as e:
+                logging.exception(e)
+                ok = False
+            if ok:
+                await sleep(self.interval)
+            else:
+                await sleep(min(self.interval, IP_RETRY_DELAY * 2 ** max(0, self.failures - 1)))
+
+
+IP_MONITOR: PublicIPMonitor = PublicIPMonitor()
+
+
+# ---------------------------------System Stats---------------------------------
+
+
+class RingBuffer:
+    """The last `capacity` values of a series, in a preallocated array (the oldest value is overwritten first)."""
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity: int = max(1, capacity)
+        self.values: array = array("d", bytes(8 * self.capacity))
+        self.next: int = 0
+        self.count: int = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, value: float):
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def last(self, n: int) -> list[float]:
+        # Oldest first
+        n = min(n, self.count)
+        if n <= 0:
+            return []
+        start = (self.next - n) % self.capacity
+        if start < self.next:
+            return self.values[start : self.next].tolist()
+        return self.values[start:].tolist() + self.values[: self.next].tolist()
+
+
+class SystemStats:
+    """Samples CPU, memory, disk, network and load with psutil every `interval` seconds, keeping `history`
+    seconds of each in a ring buffer, so that /stats answers from memory instead of running `uptime`, `free`,
+    `df` or `top`. A metric above its STATS_ALERTS threshold for STATS_ALERT_SAMPLES samples in a row is
+    reported to all users once, and again when it is back below.
+    """
+
+    # Metric name: (label, unit), where unit is "%", "B/s" (a rate computed from a counter) or "" (load average)
+    series: dict[str, tuple[str, str]] = {
+        "cpu": ("CPU", "%"),
+        "memory": ("Memory", "%"),
+        "swap": ("Swap", "%"),
+        "disk": ("Disk", "%"),
+        "disk_read": ("Disk read", "B/s"),
+        "disk_write": ("Disk write", "B/s"),
+        "net_recv": ("Net in", "B/s"),
+        "net_sent": ("Net out", "B/s"),
+        "load": ("Load 1m", ""),
+    }
+
+    def __init__(self, interval: float = STATS_INTERVAL, history: float = STATS_HISTORY) -> None:
+        self.interval: float = interval
+        self.buffers: dict[str, RingBuffer] = {}
+        self.counters: dict[str, float] = {}
+        self.counters_time: float = 0.0
+        self.above: dict[str, int] = {}
+        self.alerted: set[str] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.configure(interval, history)
+
+    def configure(self, interval: float, history: float):
+        self.interval = interval
+        capacity = int(history / interval) if interval > 0 else 1
+        self.buffers = {name: RingBuffer(capacity) for name in self.series}
+
+    def start(self):
+        if self.task is None and self.interval > 0:
+            self.task = asyncio.create_task(self.run())
+
+    def read_counters(self) -> dict[str, float]:
+        disk = psutil.disk_io_counters()
+        net = psutil.net_io_counters()
+        return {
+            "disk_read": disk.read_bytes if disk else 0,
+            "disk_write": disk.write_bytes if disk else 0,
+            "net_recv": net.bytes_recv if net else 0,
+            "net_sent": net.bytes_sent if net else 0,
+        }
+
+    def sample(self) -> dict[str, float]:
+        # Runs in a worker thread: psutil reads /proc (or the platform's equivalent), and disk_usage() can block
+        values: dict[str, float] = {
+            "cpu": psutil.cpu_percent(interval=None),
+            "memory": psutil.virtual_memory().percent,
+            "swap": psutil.swap_memory().percent,
+            "disk": psutil.disk_usage(STATS_DISK_PATH).percent,
+            "load": psutil.getloadavg()[0],
+        }
+        now = time.monotonic()
+        counters = self.read_counters()
+        elapsed = max(now - self.counters_time, 1e-9)
+        for name, value in counters.items():
+            # Counters can go back (e.g. a network interface was removed)
+            values[name] = max(0.0, value - self.counters.get(name, value)) / elapsed
+        self.counters = counters
+        self.counters_time = now
+        return values
+
+    def prime(self):
+        # The first CPU percentage and rates are measured from here
+        psutil.cpu_percent(interval=None)
+        self.counters = self.read_counters()
+        self.counters_time = time.monotonic()
+
+    async def run(self):
+        await asyncio.to_thread(self.prime)
+        while True:
+            await sleep(self.interval)
+            try:
+                values = await asyncio.to_thread(self.sample)
+                for name, value in values.items():
+                    self.buffers[name].append(value)
+                await self.check_alerts(values)
+            except Exception as e:
+                logging.exception(e)
+
+    def format_value(self, name: str, value: float) -> str:
+        unit = self.series[name][1]
+        if unit == "%":
+            return f"{value:.1f}%"
+        if unit == "B/s":
+            return f"{format_bytes(value)}/s"
+        return f"{value:.2f}"
+
+    async def check_alerts(self, values: dict[str, float]):
+        for name, threshold in STATS_ALERTS.items():
+            value = values.get(name)
+            if value is None:
+                continue
+            label = self.series[name][0]
+            if value >= threshold:
+                self.above[name] = self.above.get(name, 0) + 1
+                if self.above[name] >= STATS_ALERT_SAMPLES and name not in self.alerted:
+                    self.alerted.add(name)
+                    msg = (
+                        f"High {label}: {self.format_value(name, value)} "
+                        f"(over {self.format_value(name, threshold)} for the last {STATS_ALERT_SAMPLES} samples)"
+                    )
+                    logging.warning(msg)
+                    await send_msg_to_all_users(msg)
+            else:
+                self.above[name] = 0
+                if name in self.alerted:
+                    self.alerted.discard(name)
+                    msg = f"{label} back to normal: {self.format_value(name, value)}"
+                    logging.info(msg)
+                    await send_msg_to_all_users(msg)
+
+    def summary(self, minutes: float) -> str:
+        samples = max(1, int(minutes * 60 / self.interval))
+        count = min(samples, len(self.buffers["cpu"]))
+        window = count * self.interval
+        span = f"{round(window / 60, 1):g} min" if window >= 60 else f"{window:g}s"
+        uptime = int(time.time() - psutil.boot_time())
+        lines = [
+            f"Last {span} ({count} samples every {self.interval:g}s), "
+            f"up {uptime // 86400}d {uptime % 86400 // 3600}h {uptime % 3600 // 60}m, disk {STATS_DISK_PATH}",
+            f"{'':<10} {'now':>11} {'min':>11} {'avg':>11} {'max':>11}",
+        ]
+        for name, (label, unit) in self.series.items():
+            values = self.buffers[name].last(samples)
+            low, high = min(values), max(values)
+            spark = sparkline(values, 0.0, 100.0) if unit == "%" else sparkline(values, 0.0, high)
+            cells = [self.format_value(name, value) for value in [values[-1], low, sum(values) / len(values), high]]
+            lines.append(f"{label:<10} " + " ".join(f"{cell:>11}" for cell in cells) + f"  {spark}")
+        return "\n".join(lines)
+
+
+STATS: SystemStats = SystemStats()
+
+
+# -------------------------------Command Executor-------------------------------
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class CommandResult(subprocess.CompletedProcess):
+    """A finished command, with the CPU time (user + system, in seconds) and peak RSS (in bytes) of the
+    command and everything it waited for, when they could be measured (POSIX only, and the peak RSS only
+    when it is above the bot's own).
+    """
+
+    def __init__(
+        self,
+        args,
+        returncode: int,
+        stdout: str,
+        stderr: str,
+        cpu_time: Optional[float] = None,
+        max_rss: Optional[int] = None,
+    ) -> None:
+        super().__init__(args, returncode, stdout, stderr)
+        self.cpu_time: Optional[float] = cpu_time
+        self.max_rss: Optional[int] = max_rss
+
+
+class CommandProcess:
+    """A one-shot command started by CommandExecutor on POSIX, in its own session.
+
+    It is reaped with wait4() instead of by asyncio's child watcher, for the CPU time and peak RSS of the
+    command and everything it waited for. Its exit is noticed through a pidfd on Linux, and by a thread
+    blocked in wait4() elsewhere.
+    """
+
+    def __init__(self, popen: subprocess.Popen) -> None:
+        self.popen: subprocess.Popen = popen
+        self.pid: int = popen.pid
+        self.stdout: Optional[asyncio.StreamReader] = None
+        self.stderr: Optional[asyncio.StreamReader] = None
+        self.transports: list[asyncio.BaseTransport] = []
+        self.returncode: Optional[int] = None
+        self.cpu_time: Optional[float] = None
+        self.max_rss: Optional[int] = None
+        self.exited: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    @classmethod
+    async def start(cls, command: str) -> "CommandProcess":
+        popen = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+            preexec_fn=EXEC_POLICY.preexec_fn(),
+        )
+        process = cls(popen)
+        process.watch()
+        process.stdout = await process.connect(popen.stdout)
+        process.stderr = await process.connect(popen.stderr)
+        return process
+
+    async def connect(self, pipe) -> asyncio.StreamReader:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        self.transports.append(transport)
+        return reader
+
+    def watch(self):
+        loop = asyncio.get_running_loop()
+        pidfd: Optional[int] = None
+        if hasattr(os, "pidfd_open"):
+            with contextlib.suppress(OSError):
+                pidfd = os.pidfd_open(self.pid)
+        if pidfd is not None:
+            fd = pidfd
+
+            def on_exit():
+                loop.remove_reader(fd)
+                os.close(fd)
+                self.reap(*os.wait4(self.pid, 0)[1:])
+
+            loop.add_reader(fd, on_exit)
+            return
+
+        def wait():
+            _, status, usage = os.wait4(self.pid, 0)
+            loop.call_soon_threadsafe(self.reap, status, usage)
+
+        threading.Thread(target=wait, name=f"wait-{self.pid}", daemon=True).start()
+
+    def reap(self, status: int, usage):
+        self.returncode = os.waitstatus_to_exitcode(status)
+        # Stops subprocess from waiting for the (possibly reused) pid again
+        self.popen.returncode = self.returncode
+        self.cpu_time = usage.ru_utime + usage.ru_stime
+        # The kernel counts the peak RSS of the bot (the process that was replaced by exec) in the command's,
+        # so a peak up to the bot's own is not the command's and is left out
+        if usage.ru_maxrss > resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+            self.max_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        self.exited.set_result(self.returncode)
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self.exited)
+
+    async def communicate(self) -> tuple[bytes, bytes]:
+        assert self.stdout and self.stderr
+        stdout, stderr, _ = await asyncio.gather(self.stdout.read(), self.stderr.read(), self.wait())
+        return stdout, stderr
+
+    def kill(self):
+        # The whole process group, so that a timeout does not leave the command's children behind
+        os.killpg(self.pid, signal.SIGKILL)
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+
+
+class ExecutionPolicy:
+    """Priority and resource limits of every command and shell the bot starts, so that they cannot starve
+    the bot itself (POSIX only). Applied in the child between fork and exec, and inherited by everything it
+    starts: a nice level, an I/O priority, rlimits and, if EXEC_CGROUP is set, a cgroup v2 with CPU and
+    memory caps shared by all of them.
+    """
+
+    def __init__(self) -> None:
+        self.nice: int = 0
+        self.ionice: Optional[tuple[int, int]] = None
+        self.rlimits: list[tuple[int, int]] = []
+        self.cgroup_procs: Optional[str] = None
+
+    def configure(self):
+        if sys.platform == "win32":
+            return
+        self.nice = EXEC_NICE
+        self.ionice = None
+        io_class, _, level = EXEC_IONICE.partition(":")
+        if io_class == "idle" and hasattr(psutil, "IOPRIO_CLASS_IDLE"):
+            self.ionice = (psutil.IOPRIO_CLASS_IDLE, 0)
+        elif io_class == "best-effort" and hasattr(psutil, "IOPRIO_CLASS_BE"):
+            self.ionice = (psutil.IOPRIO_CLASS_BE, int(level))
+        self.rlimits = [(getattr(resource, f"RLIMIT_{name.upper()}"), value) for name, value in EXEC_RLIMITS.items()]
+        self.cgroup_procs = self.setup_cgroup() if EXEC_CGROUP else None
+
+    def setup_cgroup(self) -> Optional[str]:
+        # EXEC_CGROUP must be in a part of the hierarchy the bot's user can write to (e.g. a systemd
+        # delegated slice). The controllers are enabled in its parent if they are not already.
+        try:
+            makedirs(EXEC_CGROUP, exist_ok=True)
+            controllers = ["cpu"] if EXEC_CGROUP_CPU_PERCENT else []
+            controllers += ["memory"] if EXEC_CGROUP_MEMORY_MAX else []
+            with open(path.join(EXEC_CGROUP, "cgroup.controllers"), "r") as file:
+                available = file.read().split()
+            missing = [controller for controller in controllers if controller not in available]
+            if missing:
+                with open(path.join(path.dirname(EXEC_CGROUP), "cgroup.subtree_control"), "w") as file:
+                    file.write(" ".join(f"+{controller}" for controller in missing))
+            if EXEC_CGROUP_CPU_PERCENT:
+                with open(path.join(EXEC_CGROUP, "cpu.max"), "w") as file:
+                    file.write(f"{EXEC_CGROUP_CPU_PERCENT * CGROUP_CPU_PERIOD // 100} {CGROUP_CPU_PERIOD}")
+            if EXEC_CGROUP_MEMORY_MAX:
+                with open(path.join(EXEC_CGROUP, "memory.max"), "w") as file:
+                    file.write(str(EXEC_CGROUP_MEMORY_MAX))
+            procs = path.join(EXEC_CGROUP, "cgroup.procs")
+            if not os.access(procs, os.W_OK):
+                raise PermissionError(f"{procs} is not writable")
+        except OSError as e:
+            logging.error(f"Unable to set up cgroup {EXEC_CGROUP}, commands will run without it: {e}")
+            return None
+        logging.info(f"Commands will run in cgroup {EXEC_CGROUP}")
+        return procs
+
+    def preexec_fn(self) -> Optional[Callable[[], None]]:
+        # Without a preexec_fn, subprocess can use vfork(), which is much cheaper than fork() for a large bot
+        if self.nice or self.ionice is not None or self.rlimits or self.cgroup_procs is not None:
+            return self.apply
+        return None
+
+    def apply(self):
+        # Runs in the child before exec, so nothing here may log or leave the child half set up on error.
+        # Each setting is applied on a best-effort basis.
+        if self.cgroup_procs is not None:
+            with contextlib.suppress(OSError):
+                with open(self.cgroup_procs, "w") as file:
+                    file.write(str(os.getpid()))
+        if self.nice:
+            with contextlib.suppress(OSError):
+                os.nice(self.nice)
+        if self.ionice is not None:
+            with contextlib.suppress(psutil.Error, OSError, ValueError):
+                psutil.Process().ionice(*self.ionice)
+        for limit, value in self.rlimits:
+            with contextlib.suppress(OSError, ValueError):
+                _, hard = resource.getrlimit(limit)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                resource.setrlimit(limit, (value, value))
+
+
+EXEC_POLICY: ExecutionPolicy = ExecutionPolicy()
+
+
+class CommandExecutor:
+    """Runs one-shot commands without blocking the event loop.
+
+    At most `max_workers` commands run at once across all users, and each user's
+    commands run one after the other in the order they were sent.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_CMD_WORKERS, max_queue_size: int = DEFAULT_CMD_QUEUE_SIZE) -> None:
+        self.max_workers: int = max_workers
+        self.max_queue_size: int = max_queue_size
+        self.in_flight: int = 0
+        self.user_locks: dict[int, Lock] = {}
+        self.user_pending: dict[int, int] = {}
+        self.user_running: set[int] = set()
+        self.workers_cond: Optional[asyncio.Condition] = None
+
+    def pending(self, user_id: int) -> int:
+        # Queued commands plus the one currently running for this user, if any
+        return self.user_pending.get(user_id, 0)
+
+    def queue_depth(self, user_id: Optional[int] = None) -> int:
+        if user_id is not None:
+            return self.pending(user_id) - (1 if user_id in self.user_running else 0)
+        return sum(self.user_pending.values()) - len(self.user_running)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queue_depth(),
+            "max_workers": self.max_workers,
+            "max_queue_size": self.max_queue_size,
+        }
+
+    async def acquire_worker(self):
+        # A Condition instead of a Semaphore so that max_workers can change at runtime
+        if self.workers_cond is None:
+            self.workers_cond = asyncio.Condition()
+        async with self.workers_cond:
+            await self.workers_cond.wait_for(lambda: self.in_flight < self.max_workers)
+            self.in_flight += 1
+
+    async def release_worker(self):
+        assert self.workers_cond
+        async with self.workers_cond:
+            self.in_flight -= 1
+            self.workers_cond.notify()
+
+    async def run(
+        self,
+        user_id: int,
+        command: str,
+        timeout: float,
+        on_output: Optional[Callable[[str], None]] = None,
+    ) -> CommandResult:
+        if self.queue_depth(user_id) >= self.max_queue_size:
+            raise QueueFullError(f"Too many queued commands ({self.max_queue_size}). Wait for some to finish.")
+        lock = self.user_locks.setdefault(user_id, Lock())
+        self.user_pending[user_id] = self.user_pending.get(user_id, 0) + 1
+        try:
+            async with lock:
+                with METRICS.timer("command_queue_wait_seconds"):
+                    await self.acquire_worker()
+                self.user_running.add(user_id)
+                try:
+                    with METRICS.timer("command_execution_seconds"):
+                        return await self.execute(command, timeout, on_output)
+                finally:
+                    self.user_running.discard(user_id)
+                    await self.release_worker()
+        finally:
+            self.user_pending[user_id] -= 1
+            if self.user_pending[user_id] == 0:
+                del self.user_pending[user_id]
+                del self.user_locks[user_id]
+
+    async def execute(
+        self,
+        command: str,
+        timeout: float,
+        on_output: Optional[Callable[[str], None]] = None,
+    ) -> CommandResult:
+        process: Union[asyncio.subprocess.Process, CommandProcess]
+        if sys.platform == "win32":
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        else:
+            process = await CommandProcess.start(command)
+        try:
+            if on_output is None:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+            else:
+                stdout, stderr = await asyncio.wait_for(self.stream(process, on_output), timeout=timeout)
+        except asyncio.TimeoutError:
+            await self.kill(process)
+            raise subprocess.TimeoutExpired(command, timeout)
+        except asyncio.CancelledError:
+            await self.kill(process)
+            raise
+        finally:
+            if isinstance(process, CommandProcess):
+                process.close()
+        assert process.returncode is not None
+        return CommandResult(
+            command,
+            process.returncode,
+            stdout.decode(errors="ignore"),
+            stderr.decode(errors="ignore"),
+            cpu_time=getattr(process, "cpu_time", None),
+            max_rss=getattr(process, "max_rss", None),
+        )
+
+    async def stream(
+        self, process: Union[asyncio.subprocess.Process, CommandProcess], on_output: Callable[[str], None]
+    ) -> tuple[bytes, bytes]:
+        # Like communicate(), but reports decoded output (stdout and stderr interleaved) as soon as it arrives
+        async def read_all(stream: Optional[asyncio.StreamReader]) -> bytes:
+            if stream is None:
+                return b""
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+            chunks: list[bytes] = []
+            while True:
+                data = await stream.read(4096)
+                if not data:
+                    break
+                chunks.append(data)
+                on_output(decoder.decode(data))
+            return b"".join(chunks)
+
+        stdout, stderr = await asyncio.gather(read_all(process.stdout), read_all(process.stderr))
+        await process.wait()
+        return stdout, stderr
+
+    async def kill(self, process: Union[asyncio.subprocess.Process, CommandProcess]):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+EXECUTOR: CommandExecutor = CommandExecutor()
+
+# ---------------------------------Remote Agents--------------------------------
+
+
+class AgentError(Exception):
+    pass
+
+
+def agent_mac(nonce: str) -> str:
+    return hmac.new(AGENT_SECRET.encode(), nonce.encode(), hashlib.sha256).hexdigest()
+
+
+class AgentSession:
+    """Signs and verifies the frames of one authenticated connection.
+
+    The key is derived from AGENT_SECRET and both handshake nonces, and each frame is signed together
+    with its direction and sequence number, so frames cannot be forged, altered, replayed, reordered
+    or reflected back to their sender. Frames are not encrypted.
+    """
+
+    def __init__(self, challenge_nonce: str, auth_nonce: str, is_agent: bool) -> None:
+        self.key: bytes = hmac.new(AGENT_SECRET.encode(), f"session:{challenge_nonce}:{auth_nonce}".encode(), hashlib.sha256).digest()
+        self.send_label: bytes = b"agent" if is_agent else b"bot"
+        self.receive_label: bytes = b"bot" if is_agent else b"agent"
+        self.sent: int = 0
+        self.received: int = 0
+
+    def mac(self, label: bytes, seq: int, data: bytes) -> bytes:
+        return hmac.new(self.key, label + seq.to_bytes(8, "big") + data, hashlib.sha256).digest()
+
+    def sign(self, data: bytes) -> bytes:
+        mac = self.mac(self.send_label, self.sent, data)
+        self.sent += 1
+        return data + mac
+
+    def verify(self, payload: bytes) -> bytes:
+        data, mac = payload[:-AGENT_MAC_SIZE], payload[-AGENT_MAC_SIZE:]
+        if len(payload) < AGENT_MAC_SIZE or not hmac.compare_digest(mac, self.mac(self.receive_label, self.received, data)):
+            raise AgentError("Frame authentication failed")
+        self.received += 1
+        return data
+
+
+async def read_frame(reader: asyncio.StreamReader, max_size: int = AGENT_MAX_FRAME, session: Optional[AgentSession] = None) -> dict:
+    # Frames are JSON objects preceded by their length as a 4-byte big-endian integer, and followed by
+    # a MAC once the connection has a session
+    size = int.from_bytes(await reader.readexactly(4), "big")
+    if size > max_size:
+        raise AgentError(f"Frame too large ({format_bytes(size)})")
+    data = await reader.readexactly(size)
+    if session is not None:
+        data = session.verify(data)
+    frame = json.loads(data)
+    if not isinstance(frame, dict):
+        raise AgentError("Malformed frame")
+    return frame
+
+
+def write_frame(writer: asyncio.StreamWriter, frame: dict, session: Optional[AgentSession] = None):
+    data = json.dumps(frame).encode()
+    if len(data) + (AGENT_MAC_SIZE if session is not None else 0) > AGENT_MAX_FRAME:
+        raise AgentError(f"Frame too large ({format_bytes(len(data))})")
+    if session is not None:
+        data = session.sign(data)
+    writer.write(len(data).to_bytes(4, "big") + data)
+
+
+class AgentConnection:
+    """Persistent, authenticated connection to one agent, shared by all concurrent requests to it.
+
+    Requests carry an id and the agent answers them as they finish, in any order. The connection is
+    opened on first use and reopened by the next request after it is lost.
+    """
+
+    def __init__(self, name: str, host: str, port: int) -> None:
+        self.name: str = name
+        self.host: str = host
+        self.port: int = port
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.session: Optional[AgentSession] = None
+        self.pending: dict[int, asyncio.Future] = {}
+        self.next_id: int = 0
+        self.connect_lock: Optional[Lock] = None
+
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        if self.connect_lock is None:
+            self.connect_lock = Lock()
+        async with self.connect_lock:
+            if self.connected():
+                return
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), AGENT_CONNECT_TIMEOUT)
+            try:
+                session = await asyncio.wait_for(self.handshake(reader, writer), AGENT_CONNECT_TIMEOUT)
+            except BaseException:
+                writer.close()
+                raise
+            self.writer = writer
+            self.session = session
+            asyncio.create_task(self.read_loop(reader, writer, session))
+            logging.info(f"Connected to agent {self.name} ({self.host}:{self.port})")
+
+    async def handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> AgentSession:
+        # Both sides prove they know AGENT_SECRET by signing a nonce chosen by the other
+        challenge = await read_frame(reader, AGENT_AUTH_MAX_FRAME)
+        challenge_nonce = str(challenge.get("nonce"))
+        nonce = os.urandom(16).hex()
+        write_frame(writer, {"type": "auth", "mac": agent_mac(challenge_nonce), "nonce": nonce})
+        await writer.drain()
+        try:
+            ready = await read_frame(reader, AGENT_AUTH_MAX_FRAME)
+        except asyncio.IncompleteReadError:
+            raise AgentError(f"Agent {self.name} rejected authentication (check AGENT_SECRET)")
+        if ready.get("type") != "ready" or not hmac.compare_digest(str(ready.get("mac")), agent_mac(nonce)):
+            raise AgentError(f"Authentication with agent {self.name} failed")
+        return AgentSession(challenge_nonce, nonce, is_agent=False)
+
+    async def read_loop(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, session: AgentSession):
+        try:
+            while True:
+                frame = await read_frame(reader, session=session)
+                future = self.pending.get(frame.get("id", -1))
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except AgentError as e:
+            logging.warning(f"Closing connection to agent {self.name}: {e}")
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            logging.warning(f"Connection to agent {self.name} closed")
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(AgentError(f"Connection to agent {self.name} lost"))
+
+    async def request(self, frame: dict, timeout: float) -> dict:
+        await self.connect()
+        assert self.writer and self.session
+        self.next_id += 1
+        request_id = self.next_id
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            write_frame(self.writer, {**frame, "id": request_id}, self.session)
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            del self.pending[request_id]
+
+
+class AgentPool:
+    """Connections to the agents in AGENT_HOSTS, each opened once and reused by every command sent to it."""
+
+    def __init__(self) -> None:
+        self.hosts: dict[str, tuple[str, int]] = {}
+        self.connections: dict[str, AgentConnection] = {}
+
+    def names(self) -> list[str]:
+        return [LOCAL_HOST_NAME] + list(self.hosts)
+
+    def get(self, name: str) -> AgentConnection:
+        if name not in self.hosts:
+            raise AgentError(f"Unknown host: {name}")
+        connection = self.connections.get(name)
+        if connection is None or (connection.host, connection.port) != self.hosts[name]:
+            connection = AgentConnection(name, *self.hosts[name])
+            self.connections[name] = connection
+        return connection
+
+    async def run(self, name: str, user_id: int, command: str, timeout: float) -> CommandResult:
+        if name == LOCAL_HOST_NAME:
+            return await EXECUTOR.run(user_id, command, timeout)
+        if not AGENT_SECRET:
+            raise AgentError("AGENT_SECRET is not set")
+        request = {"type": "run", "user": user_id, "command": command, "timeout": timeout}
+        frame = await self.get(name).request(request, timeout + AGENT_CONNECT_TIMEOUT)
+        if frame.get("type") != "result":
+            raise AgentError(str(frame.get("error", "Unexpected response")))
+        return CommandResult(
+            command,
+            int(frame["returncode"]),
+            str(frame["stdout"]),
+            str(frame["stderr"]),
+            cpu_time=frame.get("cpu_time"),
+            max_rss=frame.get("max_rss"),
+        )
+
+    async def fan_out(
+        self, names: list[str], user_id: int, command: str, timeout: float
+    ) -> dict[str, Union[subprocess.CompletedProcess, BaseException]]:
+        results = await asyncio.gather(*(self.run(name, user_id, command, timeout) for name in names), return_exceptions=True)
+        return dict(zip(names, results))
+
+
+AGENTS: AgentPool = AgentPool()
+
+
+class AgentServer:
+    """Agent mode (`main.py --agent`): runs the commands sent by authenticated bot instances with EXECUTOR."""
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Agent listening on {host}:{port}")
+        logging.info(f"Agent listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        tasks: set[asyncio.Task] = set()
+        try:
+            nonce = os.urandom(16).hex()
+            write_frame(writer, {"type": "challenge", "nonce": nonce})
+            await writer.drain()
+            auth = await asyncio.wait_for(read_frame(reader, AGENT_AUTH_MAX_FRAME), AGENT_CONNECT_TIMEOUT)
+            if auth.get("type") != "auth" or not hmac.compare_digest(str(auth.get("mac")), agent_mac(nonce)):
+                logging.warning(f"Agent authentication failed for {peer}")
+                return
+            write_frame(writer, {"type": "ready", "mac": agent_mac(str(auth.get("nonce")))})
+            await writer.drain()
+            session = AgentSession(nonce, str(auth.get("nonce")), is_agent=True)
+            logging.info(f"Bot connected from {peer}")
+            while True:
+                frame = await read_frame(reader, session=session)
+                if frame.get("type") == "run":
+                    task = asyncio.create_task(self.run(frame, writer, session))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.TimeoutError):
+            pass
+        except AgentError as e:
+            logging.warning(f"Closing connection from {peer}: {e}")
         except Exception as e:
             logging.exception(e)
-        await sleep(60 * 60)  # Check every hour
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            logging.info(f"Connection from {peer} closed")
+
+    async def run(self, frame: dict, writer: asyncio.StreamWriter, session: AgentSession):
+        request_id = frame.get("id")
+        started = time.monotonic()
+        try:
+            command = str(frame["command"])
+            logging.info(f"Executing command sent by user ID {frame.get('user')}: {command}")
+            result = await EXECUTOR.run(int(frame["user"]), command, float(frame["timeout"]))
+            audit_command(int(frame["user"]), None, command, started, result)
+            response = {
+                "type": "result",
+                "id": request_id,
+                "returncode": result.returncode,
+                "stdout": result.stdout,
+                "stderr": result.stderr,
+                "cpu_time": result.cpu_time,
+                "max_rss": result.max_rss,
+            }
+        except Exception as e:
+            audit_command(int(frame.get("user") or 0), None, str(frame.get("command")), started, e)
+            response = {"type": "error", "id": request_id, "error": str(e)}
+        try:
+            try:
+                write_frame(writer, response, session)
+            except AgentError as e:
+                write_frame(writer, {"type": "error", "id": request_id, "error": f"Output too large to send: {e}"}, session)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+async def run_agent():
+    if not AGENT_SECRET:
+        logging.error("AGENT_SECRET environment variable not set. Aborting.")
+        print("AGENT_SECRET environment variable not set. Aborting.")
+        exit(1)
+    LOOP_MONITOR.start()
+    if METRICS_PORT:
+        await METRICS.serve(METRICS_PORT)
+    await AgentServer().serve(*AGENT_LISTEN)
+
+
+class OutputHistory:
+    """Latest output of each user's recent commands, at most `max_entries` per user (least recently run dropped first)."""
+
+    def __init__(self, max_entries: int = OUTPUT_HISTORY_SIZE) -> None:
+        self.max_entries: int = max_entries
+        self.entries: dict[int, collections.OrderedDict[str, str]] = {}
+
+    def swap(self, user_id: int, command: str, body: str) -> Optional[str]:
+        # Stores body as the latest output of command and returns the one it replaces
+        entries = self.entries.setdefault(user_id, collections.OrderedDict())
+        previous = entries.pop(command, None)
+        if len(body) <= OUTPUT_HISTORY_MAX_SIZE:
+            entries[command] = body
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+        return previous
+
+    def clear(self):
+        self.entries.clear()
+
+
+OUTPUT_HISTORY: OutputHistory = OutputHistory()
+
+
+class LiveOutput:
+    """A single message that is edited in place with the tail of a running command's output."""
+
+    def __init__(self, channel, command: str) -> None:
+        self.channel = channel
+        self.command: str = command
+        self.log: LogBuffer = LogBuffer(STREAM_TAIL_LINES)
+        self.truncated: bool = False
+        self.message: Optional[Message] = None
+        self.start_time: float = time.monotonic()
+        self.dirty: asyncio.Event = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.sending: bool = False
+        self.finishing: bool = False
+
+    def feed(self, text: str):
+        if not text:
+            return
+        if self.log.append(text) > 0:
+            self.truncated = True
+        self.dirty.set()
+        if self.task is None and not self.finishing:
+            self.task = asyncio.create_task(self.update_loop())
+
+    def build_message(self, status: Optional[str] = None) -> str:
+        if status is None:
+            status = f"RUNNING {time.monotonic() - self.start_time:.0f}s"
+        prefix = "```sh\n"
+        header = f"[{status}]\n"
+        suffix = "\n```"
+        start = self.log.fit_tail(MAX_MESSAGE_SIZE - len(prefix + header + "…\n" + suffix))
+        if start > 0 or self.truncated:
+            header += "…\n"
+        return prefix + header + self.log.join(start).rstrip("\n") + suffix
+
+    async def update_loop(self):
+        # Commands that finish within the first interval never get a live message, only the result
+        await sleep(STREAM_EDIT_INTERVAL)
+        while not self.finishing:
+            await self.dirty.wait()
+            self.dirty.clear()
+            self.sending = True
+            try:
+                content = self.build_message()
+                if self.message is None:
+                    self.message = await self.channel.send(content)
+                else:
+                    await self.message.edit(content=content)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                self.sending = False
+            if self.finishing:
+                return
+            await sleep(STREAM_EDIT_INTERVAL)
+
+    async def finish(self, content: Optional[str] = None, files: Optional[list[File]] = None, status: str = "FINISHED") -> bool:
+        # Replaces the live message with the final result. Returns False if no live message was ever sent.
+        self.finishing = True
+        if self.task is not None:
+            # A send in flight is let through, otherwise its message would be left behind unedited
+            if not self.sending:
+                self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.message is None:
+            return False
+        if content is None:
+            content = self.build_message(status)
+        await self.message.edit(content=content)
+        for file in files or []:
+            await self.channel.send(file=file)
+        return True
 
 
 # ----------------------------------Events--------------------------------------
@@ -232,30 +2207,46 @@ async def on_message(message: Message):
     if not is_user_allowed(author):
         await channel.send("You are not authorized to use this bot.")
         logging.warning(f"Unauthorized access attempt by user {author} (ID: {author.id})")
+        audit("unauthorized", author.id, user=author.name, command=command)
         return
-    await channel.send(f"Executing command: {command}")
+    ahead: int = EXECUTOR.pending(author.id)
+    if ahead > 0:
+        await channel.send(f"Queued command ({ahead} ahead): {command}")
+    else:
+        await channel.send(f"Executing command: {command}")
     async with channel.typing():
         try:
             # Execute the command
             logging.info(f"Executing command sent by user {author.name} (ID: {author.id}): {command}")
-            result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=CMD_TIMEOUT)
+            live = LiveOutput(channel, command) if STREAM_OUTPUT else None
+            started = time.monotonic()
+            try:
+                result = await EXECUTOR.run(author.id, command, CMD_TIMEOUT, on_output=live.feed if live else None)
+            except Exception as e:
+                audit_command(author.id, author.name, command, started, e)
+                if live is not None:
+                    await live.finish(status="STOPPED")
+                raise
+            audit_command(author.id, author.name, command, started, result)
             # Build the output and send to the channel
             prefix: str = "```sh\n"
             suffix: str = "\n```"
-            body = f"[RETURN_CODE={result.returncode}]"
-            if result.stdout and len(result.stdout.strip()) > 0:
-                body += f"\n[OUTPUT]\n{result.stdout}"
-            if result.stderr and len(result.stderr.strip()) > 0:
-                body += f"\n[ERRORS]\n{result.stderr}"
-            if len(prefix + body + suffix) <= 2000:
-                await channel.send(prefix + body + suffix)
+            body = format_result(result)
+            if COMPACT_OUTPUT:
+                previous = OUTPUT_HISTORY.swap(author.id, command, body)
+                body = await asyncio.to_thread(compact_output, body, previous)
+            body = add_usage(body, result)
+            if len(prefix + body + suffix) <= MAX_MESSAGE_SIZE:
+                if live is None or not await live.finish(prefix + body + suffix):
+                    await channel.send(prefix + body + suffix)
                 return
             # If the output is too large, send it as a file
-            temp_file_path = path.join(TEMP_PATH, f"output_{message.id}.txt")
-            with open(temp_file_path, "w") as f:
-                f.write(body)
-            await channel.send(file=File(temp_file_path))
-            remove(temp_file_path)
+            files = await build_attachments(body, f"output_{message.id}.txt")
+            if live is None or not await live.finish(files=files, status=f"RETURN_CODE={result.returncode}"):
+                for file in files:
+                    await channel.send(file=file)
+        except QueueFullError as e:
+            await channel.send(str(e))
         except Exception as e:
             logging.exception(e)
             await channel.send(f"An error occurred while executing the command: {e}")
@@ -270,55 +2261,559 @@ async def init(interaction: Interaction):
     await interaction.response.send_message("Bot has been initialized. Check your DMs to continue.", ephemeral=True)
 
 
+class TerminalParser:
+    """Incremental terminal output parser.
+
+    Keeps the current line and cursor column across chunks, so carriage returns, backspaces and
+    erase-line redraws (progress bars) overwrite the current line instead of adding new ones, and
+    escape sequences or CRLFs split across reads are handled like any other.
+    """
+
+    def __init__(self) -> None:
+        self.line: str = ""
+        self.col: int = 0
+        self.pending: str = ""
+
+    def feed(self, text: str) -> tuple[str, str]:
+        # Returns the lines completed by `text` (each ending in "\n") and the current line
+        text = self.pending + text
+        self.pending = ""
+        incomplete = TERMINAL_INCOMPLETE_RE.search(text)
+        if incomplete and incomplete.start() < len(text) and len(text) - incomplete.start() <= TERMINAL_MAX_PENDING:
+            self.pending = text[incomplete.start() :]
+            text = text[: incomplete.start()]
+        text = TERMINAL_IGNORED_RE.sub("", text).replace("\r\n", "\n")
+        completed: list[str] = []
+        for match in TERMINAL_TOKEN_RE.finditer(text):
+            token = match.group()
+            c = token[0]
+            if c == "\r":
+                self.col = 0
+            elif c == "\x08":
+                self.col = max(0, self.col - 1)
+            elif c == "\x1b" or c == "\x9b":
+                if match.group(2) is not None:
+                    self.control(match.group(2), match.group(1))
+            else:
+                first = token.find("\n")
+                if first < 0:
+                    self.write(token)
+                    continue
+                # Lines in the middle of a text run are complete as they are
+                last = token.rfind("\n")
+                self.write(token[:first])
+                self.newline(completed)
+                if last > first:
+                    completed.append(token[first + 1 : last + 1])
+                self.write(token[last + 1 :])
+        return "".join(completed), self.line
+
+    def newline(self, completed: list[str]):
+        completed.append(self.line + "\n")
+        self.line = ""
+        self.col = 0
+
+    def write(self, text: str):
+        if self.col == len(self.line):
+            self.line += text
+        else:
+            self.line = self.line[: self.col].ljust(self.col) + text + self.line[self.col + len(text) :]
+        self.col += len(text)
+
+    def control(self, final: str, params: str):
+        # Erase in line and horizontal cursor moves
+        try:
+            n = int(params) if params else 0
+        except ValueError:
+            return
+        if final == "K":
+            if n == 0:
+                self.line = self.line[: self.col]
+            elif n == 1:
+                self.line = " " * self.col + self.line[self.col :]
+            elif n == 2:
+                self.line = ""
+        elif final == "C":
+            self.col += max(n, 1)
+        elif final == "D":
+            self.col = max(0, self.col - max(n, 1))
+        elif final == "G":
+            self.col = max(n, 1) - 1
+
+
+class RenderScheduler:
+    """Render state of one view: coalesces render requests, spaces edits at least 1/`fps` seconds
+    apart and skips edits that would not change the rendered content.
+
+    The SessionManager decides when due renders run; flush() sends the latest state right away.
+    """
+
+    def __init__(
+        self,
+        build: Callable[[], Awaitable[str]],
+        send: Callable[[str], Awaitable[None]],
+        fps: float = RENDER_FPS,
+        notify: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.build: Callable[[], Awaitable[str]] = build
+        self.send: Callable[[str], Awaitable[None]] = send
+        self.fps: float = fps
+        self.notify: Optional[Callable[[], None]] = notify
+        self.dirty: bool = False
+        self.lock: Lock = Lock()
+        self.last_content: Optional[str] = None
+        self.last_edit_time: float = 0.0
+        self.edits_sent: int = 0
+        self.edits_dropped: int = 0
+        self.latency_total: float = 0.0
+        self.latency_max: float = 0.0
+
+    def request(self):
+        if self.dirty:
+            self.edits_dropped += 1  # Coalesced with the pending render
+        self.dirty = True
+        if self.notify is not None:
+            self.notify()
+
+    def due_time(self) -> float:
+        return self.last_edit_time + 1 / self.fps
+
+    async def render(self):
+        async with self.lock:
+            start = time.monotonic()
+            with METRICS.timer("render_build_seconds"):
+                content = await self.build()
+            if content == self.last_content:
+                self.edits_dropped += 1
+                return
+            await self.send(content)
+            self.last_content = content
+            self.last_edit_time = time.monotonic()
+            latency = self.last_edit_time - start
+            self.edits_sent += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    async def flush(self):
+        self.dirty = False
+        await self.render()
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "edits_sent": self.edits_sent,
+            "edits_dropped": self.edits_dropped,
+            "latency_avg": self.latency_total / self.edits_sent if self.edits_sent else 0.0,
+            "latency_max": self.latency_max,
+        }
+
+
+class LogSpill:
+    """Log lines evicted from a LogBuffer, appended to a file and read back through mmap.
+
+    A sparse index keeps the byte offset of every LOG_SPILL_INDEX_STRIDE-th line, so finding any line
+    takes at most a stride's worth of newline searches while the index itself stays small.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        # Only readable by the bot's user: the file holds everything the shell printed
+        makedirs(path.dirname(file_path), mode=0o700, exist_ok=True)
+        self.path: str = file_path
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+        self.file = os.fdopen(fd, "r+b")
+        self.map: Optional[mmap.mmap] = None
+        self.index: array = array("q")
+        self.count: int = 0  # Lines
+        self.size: int = 0  # Bytes
+        self.chars: int = 0
+
+    def append(self, lines: list[str]):
+        chunks: list[bytes] = []
+        for line in lines:
+            if self.count % LOG_SPILL_INDEX_STRIDE == 0:
+                self.index.append(self.size)
+            data = line.encode("utf-8", errors="ignore")
+            chunks.append(data)
+            self.count += 1
+            self.size += len(data)
+            self.chars += len(line)
+        self.file.write(b"".join(chunks))
+
+    def mapped(self) -> mmap.mmap:
+        # Remapped whenever the file has grown since the last read
+        if self.map is None or len(self.map) != self.size:
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.map
+
+    def offset(self, i: int) -> int:
+        if i >= self.count:
+            return self.size
+        mapped = self.mapped()
+        pos = self.index[i // LOG_SPILL_INDEX_STRIDE]
+        for _ in range(i % LOG_SPILL_INDEX_STRIDE):
+            pos = mapped.find(b"\n", pos) + 1
+        return pos
+
+    def read(self, start: int, end: int) -> str:
+        if start >= min(end, self.count):
+            return ""
+        return self.mapped()[self.offset(start) : self.offset(end)].decode("utf-8", errors="ignore")
+
+    def snapshot(self) -> mmap.mmap:
+        # A separate read-only map of the lines spilled so far, for use off the event loop: later appends
+        # remap self.map, but leave this one alone, and it stays valid after the file is closed
+        self.file.flush()
+        return mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+
+    def iter_lines(self, start: int):
+        mapped = self.mapped() if start < self.count else None
+        pos = self.offset(start)
+        for _ in range(start, self.count):
+            assert mapped
+            end = mapped.find(b"\n", pos) + 1
+            yield mapped[pos:end].decode("utf-8", errors="ignore")
+            pos = end
+
+    def iter_lines_reversed(self, end: int):
+        mapped = self.mapped() if end > 0 else None
+        pos = self.offset(end)
+        for _ in range(end):
+            assert mapped
+            start = mapped.rfind(b"\n", 0, pos - 1) + 1
+            yield mapped[start:pos].decode("utf-8", errors="ignore")
+            pos = start
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class LogBuffer(collections.abc.Sequence):
+    """Append-only store of cleaned log lines, keeping at most `max_lines` complete lines in memory.
+
+    Indexing covers the complete lines followed by the unfinished last line, if any, which
+    is what gets rendered. Once the cap is reached the oldest lines are moved to a LogSpill file
+    at `spill_path` and stay readable, or are dropped if there is no spill path. A spill file that has
+    reached LOG_SPILL_MAX_SIZE bytes is dropped as a whole and a new one started.
+    """
+
+    def __init__(self, max_lines: int = LOG_MAX_LINES, spill_path: Optional[str] = None) -> None:
+        self.max_lines: int = max_lines
+        self.lines: list[str] = []
+        self.head: int = 0  # Index in self.lines of the oldest line still in memory
+        # offsets[i] is the position of self.lines[i] in the log, so any range of lines is sized in O(1)
+        self.offsets: list[int] = [0]
+        self.partial: str = ""
+        self.has_content: bool = False
+        self.spill_path: Optional[str] = spill_path
+        self.spill: Optional[LogSpill] = None
+        self.spilled: int = 0  # Lines before the first one in memory
+        self.dropped_lines: int = 0  # Lines discarded for good
+
+    def __len__(self) -> int:
+        return self.count_lines() + (1 if self.partial else 0)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("log line index out of range")
+        if i == self.count_lines():
+            return self.partial.rstrip() + "\n"
+        if i < self.spilled:
+            assert self.spill
+            return self.spill.read(i, i + 1)
+        return self.lines[self.memory_index(i)]
+
+    def memory_index(self, i: int) -> int:
+        return self.head + i - self.spilled
+
+    def count_lines(self) -> int:
+        return self.spilled + len(self.lines) - self.head
+
+    def partial_size(self) -> int:
+        return len(self.partial.rstrip()) + 1 if self.partial else 0
+
+    def memory_size(self) -> int:
+        return self.offsets[-1] - self.offsets[self.head] + self.partial_size()
+
+    def total_size(self) -> int:
+        return (self.spill.chars if self.spill else 0) + self.memory_size()
+
+    def fit_tail(self, max_size: int) -> int:
+        # Index of the first line of the longest tail that fits in max_size characters
+        count = self.count_lines()
+        free = max_size - self.partial_size()
+        if free < 0:
+            return len(self)
+        end = self.offsets[self.memory_index(count)]
+        start = bisect_left(self.offsets, end - free, self.head, self.memory_index(count)) - self.head + self.spilled
+        if start == self.spilled and self.spill is not None:
+            # Everything in memory fits; continue into the spilled lines
+            free -= end - self.offsets[self.head]
+            for line in self.spill.iter_lines_reversed(self.spilled):
+                if len(line) > free:
+                    break
+                free -= len(line)
+                start -= 1
+        return start
+
+    def fit_from(self, start: int, max_size: int) -> int:
+        # End (exclusive) of the longest run of lines beginning at start that fits in max_size characters
+        count = self.count_lines()
+        if max_size < 0:
+            return start
+        if start < self.spilled:
+            assert self.spill
+            for line in self.spill.iter_lines(start):
+                if len(line) > max_size:
+                    return start
+                max_size -= len(line)
+                start += 1
+        if start >= count:
+            return len(self) if start < len(self) and self.partial_size() <= max_size else start
+        limit = self.offsets[self.memory_index(start)] + max_size
+        end = bisect_right(self.offsets, limit, self.memory_index(start), self.memory_index(count) + 1) - 1 - self.head + self.spilled
+        if end == count and self.partial and self.partial_size() <= limit - self.offsets[self.memory_index(count)]:
+            end += 1
+        return end
+
+    def join(self, start: int = 0, end: Optional[int] = None) -> str:
+        count = self.count_lines()
+        if end is None:
+            end = len(self)
+        text = ""
+        if start < self.spilled:
+            assert self.spill
+            text = self.spill.read(start, min(end, self.spilled))
+        first, last = max(start, self.spilled), min(end, count)
+        if first < last:
+            text += "".join(self.lines[self.memory_index(first) : self.memory_index(last)])
+        if start <= count < end:
+            text += self.partial.rstrip() + "\n"
+        return text
+
+    def append(self, text: str) -> int:
+        # Returns the number of old lines dropped (not spilled) to stay within max_lines and LOG_SPILL_MAX_SIZE
+        if not text:
+            return 0
+        if not self.has_content and text.strip():
+            self.has_content = True
+        parts = (self.partial + text).split("\n")
+        self.partial = parts.pop()
+        for part in parts:
+            line = part.rstrip() + "\n"
+            self.lines.append(line)
+            self.offsets.append(self.offsets[-1] + len(line))
+        excess = max(0, len(self.lines) - self.head - self.max_lines)
+        if excess == 0:
+            return 0
+        dropped = excess
+        reset = 0
+        if self.spill_path is not None:
+            if self.spill is not None and self.spill.size >= LOG_SPILL_MAX_SIZE:
+                # Keeps a long-running session from filling the disk
+                reset = self.close()
+            if self.spill is None:
+                self.spill = LogSpill(self.spill_path)
+            self.spill.append(self.lines[self.head : self.head + excess])
+            self.spilled += excess
+            dropped = 0
+        self.dropped_lines += dropped
+        self.head += excess
+        if self.head > self.max_lines:
+            # Compact once the evicted prefix outgrows the kept lines, so trimming stays amortized O(1)
+            del self.lines[: self.head]
+            del self.offsets[: self.head]
+            self.head = 0
+        return dropped + reset
+
+    def write(self, lines: str, partial: str) -> int:
+        # Appends complete lines (each ending in "\n") and replaces the unfinished last line
+        self.partial = ""
+        dropped = self.append(lines)
+        self.partial = partial
+        if not self.has_content and partial.strip():
+            self.has_content = True
+        return dropped
+
+    def export(self) -> list[Union[bytes, mmap.mmap]]:
+        # The whole log as byte buffers, to be read off the event loop: a snapshot of the spill file
+        # (to be closed by the caller) followed by the lines in memory
+        buffers: list[Union[bytes, mmap.mmap]] = []
+        if self.spill is not None and self.spill.size > 0:
+            buffers.append(self.spill.snapshot())
+        buffers.append(("".join(self.lines[self.head :]) + self.partial).encode("utf-8", errors="ignore"))
+        return buffers
+
+    def close(self) -> int:
+        # Deletes the spill file; returns the number of spilled lines, which are now dropped
+        if self.spill is None:
+            return 0
+        dropped = self.spilled
+        self.spill.close()
+        self.spill = None
+        self.spilled = 0
+        self.dropped_lines += dropped
+        return dropped
+
+
+class LogSearch:
+    """Lines of a LogBuffer matching a query, indexed in one pass and extended as the log grows.
+
+    A query wrapped in slashes (/.../) is a regular expression, anything else a case-insensitive substring.
+    Line numbers are stored counting the lines dropped from the log, so they stay valid when LOG_SPILL is off.
+    """
+
+    def __init__(self, query: str) -> None:
+        self.query: str = query
+        if len(query) > 2 and query.startswith("/") and query.endswith("/"):
+            self.pattern: re.Pattern = re.compile(query[1:-1], re.MULTILINE)
+        else:
+            self.pattern = re.compile(re.escape(query), re.IGNORECASE)
+        self.matches: array = array("q")
+        self.scanned: int = 0  # First complete line not indexed yet
+        self.lock: Lock = Lock()  # Held while indexing, so that matches are only appended by one scan at a time
+
+    def backlog(self, log: LogBuffer) -> Optional[tuple[mmap.mmap, int, int]]:
+        # Spilled lines not indexed yet, as (snapshot of the spill file, byte offset, line number) for scan_spilled
+        start = max(self.scanned - log.dropped_lines, 0)
+        if log.spill is None or start >= log.spilled:
+            return None
+        return log.spill.snapshot(), log.spill.offset(start), start + log.dropped_lines
+
+    def scan_spilled(self, snapshot: mmap.mmap, pos: int, line: int):
+        # Runs in a worker thread: the first search of a long log can have the whole spill file to go through
+        for chunk in line_chunks(snapshot, LOG_SEARCH_CHUNK_SIZE, pos):
+            self.scan(chunk.decode("utf-8", errors="ignore"), line)
+            line += chunk.count(b"\n")
+        self.scanned = line
+
+    def update(self, log: LogBuffer):
+        count = log.count_lines()
+        start = max(self.scanned - log.dropped_lines, 0)
+        for chunk_start in range(start, count, LOG_SEARCH_CHUNK_LINES):
+            chunk_end = min(chunk_start + LOG_SEARCH_CHUNK_LINES, count)
+            self.scan(log.join(chunk_start, chunk_end), chunk_start + log.dropped_lines)
+        self.scanned = count + log.dropped_lines
+
+    def scan(self, text: str, line: int):
+        # Records each line of text (starting at line) with at least one match
+        pos = 0
+        while True:
+            match = self.pattern.search(text, pos)
+            if match is None or match.start() >= len(text):
+                break
+            line += text.count("\n", pos, match.start())
+            self.matches.append(line)
+            pos = text.find("\n", match.start()) + 1
+            if pos == 0:
+                break
+            line += 1
+
+    def find(self, log: LogBuffer, line: int, forward: bool = True) -> Optional[tuple[int, int, int]]:
+        # Closest matching line after (or before) line, wrapping around; returns (line, match number, match count)
+        self.update(log)
+        count = log.count_lines()
+        offset = log.dropped_lines
+        first = bisect_left(self.matches, offset)
+        complete = len(self.matches) - first
+        # The unfinished last line changes as it is written, so it is checked on every lookup instead of indexed
+        partial = 1 if log.partial and self.pattern.search(log.partial) else 0
+        total = complete + partial
+        if total == 0:
+            return None
+        if forward:
+            k = bisect_right(self.matches, line + offset, first) - first
+            if k == complete and not (partial and line < count):
+                k = 0
+        else:
+            if partial and line > count:
+                k = complete
+            else:
+                k = bisect_left(self.matches, line + offset, first) - first - 1
+            if k < 0:
+                k = total - 1
+        found = self.matches[first + k] - offset if k < complete else count
+        return found, k + 1, total
+
+
 class InteractiveShellView(ui.LayoutView):
     text = ui.TextDisplay(content="")
     row_1 = ui.ActionRow()
     row_2 = ui.ActionRow()
     row_3 = ui.ActionRow()
+    row_4 = ui.ActionRow()
 
     def __init__(self, interaction: Interaction) -> None:
         super().__init__(timeout=None)
-        self.log: str = ""
+        spill_path = path.join(SESSIONS_PATH, f"session_{uuid.uuid4().hex}.log") if LOG_SPILL else None
+        self.log: LogBuffer = LogBuffer(LOG_MAX_LINES, spill_path)
         self.log_lock: Lock = Lock()
         self.log_window_base: int = WINDOW_BASE_AUTO_SCROLL_ENABLE
         self.log_window_base_lock: Lock = Lock()
         self.interaction: Interaction = interaction
         self.process: Optional[asyncio.subprocess.Process] = None
+        self.output: Optional[asyncio.StreamReader] = None
+        self.pty_master: Optional[int] = None
+        self.terminal: TerminalParser = TerminalParser()
         self.selected_signal: int = DEFAULT_SIGNAL
+        self.stopped: bool = False
+        self.search: Optional[LogSearch] = None
+        self.search_line: int = 0
+        self.renderer: RenderScheduler = RenderScheduler(self.build_log_message, self.send_render, RENDER_FPS, SESSIONS.request_render)
 
     async def start(self, shell: str = "cmd"):
-        # Wrap POSIX shells with a PTY using `script` to avoid "no job control" warnings
-        env = None
-        env = os.environ.copy()
-        if sys.platform != "win32" and shell in ["sh", "bash", "zsh"]:
-            if shutil.which("script"):
-                shell = f"script -q -f -c {shlex.quote(shell + ' -i')} /dev/null"
-            else:
-                shell += " -i"
-            env.setdefault("TERM", "xterm")
+        shell_process = await SHELL_POOL.acquire(shell)
+        self.process = shell_process.process
+        self.pty_master = shell_process.pty_master
+        self.output = shell_process.output
+        SESSIONS.add(self, self.interaction.user, shell)
+        await self.renderer.flush()
+
+    async def write_input(self, data: bytes):
+        if self.pty_master is not None:
+            while data:
+                try:
+                    data = data[os.write(self.pty_master, data) :]
+                except BlockingIOError:
+                    await sleep(0.05)
+        elif self.process and self.process.stdin:
+            self.process.stdin.write(data)
+            await self.process.stdin.drain()
+
+    def send_signal(self, sig: int):
+        if self.pty_master is not None:
+            os.killpg(os.tcgetpgrp(self.pty_master), sig)
+        else:
+            psutil.Process(self.get_child_process()).send_signal(sig)
 
-        self.process = await asyncio.create_subprocess_shell(
-            shell,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            env=env,
-        )
-        BOT.loop.create_task(self.interactive_session_loop_task())
-        await self.render()
+    def terminate(self):
+        assert self.process
+        if self.pty_master is not None:
+            # Interactive shells ignore SIGTERM; hang up the whole session like a closed terminal would
+            os.killpg(self.process.pid, signal.SIGHUP)
+        else:
+            self.process.terminate()
 
-    def sanitize_output(self, s: str) -> str:
-        # Remove OSC (window title) and CSI (colors, bracketed paste) sequences and BELs
-        s = ANSI_OSC_RE.sub("", s)
-        s = ANSI_CSI_RE.sub("", s)
-        s = s.replace("\x07", "")  # BEL
-        # Normalize CRs
-        s = s.replace("\r\n", "\n").replace("\r", "\n")
-        return s
+    def close_pty(self):
+        if self.pty_master is not None:
+            os.close(self.pty_master)
+            self.pty_master = None
 
     async def count_log_lines(self) -> int:
         async with self.log_lock:
-            return self.log.count("\n")
+            return self.log.count_lines()
 
     async def set_log_window_base(self, value: int):
         async with self.log_window_base_lock:
@@ -338,71 +2833,100 @@ class InteractiveShellView(ui.LayoutView):
         footer = ""
         suffix = "\n```"
         async with self.log_lock:
-            body = self.log
-        if body.strip() == "":
-            return prefix + " " + suffix
-        # Clean line endings
-        lines = body.splitlines()
-        for i in range(len(lines)):
-            lines[i] = lines[i].rstrip() + "\n"
-        body = "".join(lines)
-        content = prefix + header + body + footer + suffix
-        if len(content) <= MAX_CONTENT_SIZE:
-            await self.set_auto_scroll()
-            return content
-        # Change to a window based system, by finding the highest window base (in lines) that shows the logs until the end.
-        body = ""
-        if log_window_base < 0:
-            # Either auto-scroll or auto-find base
-            header = "…\n"
-            footer = ""
-            for i in range(len(lines) - 1, -1, -1):
-                free: int = MAX_CONTENT_SIZE - len(prefix + header + body + footer + suffix)
-                if free >= len(lines[i]):
-                    body = lines[i] + body
-                else:
-                    # Line (i) does not fit anymore
-                    if log_window_base == WINDOW_BASE_AUTO_SCROLL_DISABLE:
-                        await self.set_log_window_base(i + 1 - SCROLL_AMOUNT)
-                    break
-        else:
-            if log_window_base != 0:
+            if not self.log.has_content:
+                return prefix + " " + suffix
+            fits = len(prefix + header + footer + suffix) + self.log.total_size() <= MAX_CONTENT_SIZE
+            if fits:
+                body = self.log.join()
+            # Change to a window based system, by finding the highest window base (in lines) that shows the logs until the end.
+            elif log_window_base < 0:
+                # Either auto-scroll or auto-find base
                 header = "…\n"
-            for i in range(log_window_base, len(lines)):
-                free: int = MAX_CONTENT_SIZE - len(prefix + header + body + footer + suffix)
-                if free == len(lines[i]):
-                    body += lines[i]
-                    footer = ""
-                    await self.set_auto_scroll()
-                    break
-                elif free > len(lines[i]):
-                    body += lines[i]
-                elif free < len(lines[i]):
-                    print(f"free: {free}, adding: {len(lines[i][:free-1])} ({lines[i][:free-1]})")
-                    body += lines[i][: free - 1]
+                start = self.log.fit_tail(MAX_CONTENT_SIZE - len(prefix + header + footer + suffix))
+                body = self.log.join(start)
+            else:
+                if log_window_base != 0:
+                    header = "…\n"
+                free: int = MAX_CONTENT_SIZE - len(prefix + header + suffix)
+                end = self.log.fit_from(log_window_base, free)
+                if end < len(self.log):
+                    # Cut the first line that does not fit, leaving room for the footer
                     footer = "…"
-                    break
-        print(len(prefix + header + body + footer + suffix))
+                    end = self.log.fit_from(log_window_base, free - len(footer))
+                    body = self.log.join(log_window_base, end)
+                    body += self.log[end][: free - len(footer) - len(body)]
+                else:
+                    body = self.log.join(log_window_base, end)
+        if fits:
+            await self.set_auto_scroll()
+        elif log_window_base == WINDOW_BASE_AUTO_SCROLL_DISABLE:
+            await self.set_log_window_base(start - SCROLL_AMOUNT)
+        elif log_window_base >= 0 and not footer and len(body) == free:
+            # The window ends exactly at the end of the log
+            await self.set_auto_scroll()
         return prefix + header + body + footer + suffix
 
+    async def jump_to_match(self, forward: bool, line: Optional[int] = None) -> Optional[tuple[int, int, int]]:
+        assert self.search
+        search = self.search
+        async with search.lock:
+            # Spilled lines are indexed off the event loop; update() only has the lines in memory (and any
+            # spilled meanwhile) left to do
+            async with self.log_lock:
+                backlog = search.backlog(self.log)
+            if backlog is not None:
+                snapshot, pos, first_line = backlog
+                try:
+                    await asyncio.to_thread(search.scan_spilled, snapshot, pos, first_line)
+                finally:
+                    snapshot.close()
+            async with self.log_lock:
+                result = search.find(self.log, self.search_line if line is None else line, forward)
+        if result is not None:
+            self.search_line = result[0]
+            await self.set_log_window_base(result[0])
+            self.renderer.request()
+        return result
+
     async def render_export(self, interaction: Interaction, msg: Optional[str] = None):
+        # Compressing a long log can take longer than Discord waits for the response
+        await interaction.response.defer(thinking=True)
         async with self.log_lock:
-            full_log = self.log
-        temp_file_path = path.join(TEMP_PATH, f"interactive_log_{interaction.id}.txt")
-        with open(temp_file_path, "w", encoding="utf-8", errors="ignore") as f:
-            f.write(full_log)
+            buffers = self.log.export()
+        try:
+            files = await build_attachments(buffers, f"interactive_log_{interaction.id}.txt")
+        finally:
+            for buffer in buffers:
+                if isinstance(buffer, mmap.mmap):
+                    buffer.close()
         if msg:
-            await interaction.response.send_message(content=msg, file=File(temp_file_path))
+            await interaction.followup.send(content=msg, file=files[0])
         else:
-            await interaction.response.send_message(file=File(temp_file_path))
-        remove(temp_file_path)
+            await interaction.followup.send(file=files[0])
+        for file in files[1:]:
+            await interaction.followup.send(file=file)
 
     async def append_log(self, *args):
         async with self.log_lock:
-            self.log += "".join(args)
+            with METRICS.timer("terminal_parse_seconds"):
+                lines, partial = self.terminal.feed("".join(args))
+            dropped = self.log.write(lines, partial)
+        await self.keep_window(dropped)
+
+    async def keep_window(self, dropped: int):
+        # Keep a manually scrolled window on the same lines while old ones are dropped
+        if dropped > 0:
+            async with self.log_window_base_lock:
+                if self.log_window_base >= 0:
+                    self.log_window_base = max(0, self.log_window_base - dropped)
+
+    async def close_log(self):
+        async with self.log_lock:
+            dropped = self.log.close()
+        await self.keep_window(dropped)
 
-    async def render(self):
-        self.text.content = await self.build_log_message()
+    async def send_render(self, content: str):
+        self.text.content = content
         await self.interaction.edit_original_response(view=self)
 
     @row_1.button(label="↑", style=ButtonStyle.secondary)
@@ -413,7 +2937,7 @@ class InteractiveShellView(ui.LayoutView):
                 self.log_window_base = WINDOW_BASE_AUTO_SCROLL_DISABLE
             else:
                 self.log_window_base = max(0, self.log_window_base - SCROLL_AMOUNT)
-        await self.render()
+        self.renderer.request()
 
     @row_1.button(label="↓", style=ButtonStyle.secondary)
     async def scroll_down_button(self, interaction: Interaction, button: ui.Button):
@@ -422,7 +2946,7 @@ class InteractiveShellView(ui.LayoutView):
             if self.log_window_base == WINDOW_BASE_AUTO_SCROLL_ENABLE:
                 return
             self.log_window_base = min(await self.count_log_lines() - 1, self.log_window_base + SCROLL_AMOUNT)
-        await self.render()
+        self.renderer.request()
 
     @row_1.button(label="Export Log", style=ButtonStyle.secondary)
     async def export_button(self, interaction: Interaction, button: ui.Button):
@@ -430,7 +2954,10 @@ class InteractiveShellView(ui.LayoutView):
             await self.render_export(interaction)
         except Exception as e:
             logging.exception(e)
-            await interaction.response.send_message("Failed to export log.", ephemeral=True)
+            if interaction.response.is_done():
+                await interaction.followup.send("Failed to export log.", ephemeral=True)
+            else:
+                await interaction.response.send_message("Failed to export log.", ephemeral=True)
 
     @row_2.select(placeholder="Select a signal...", min_values=1, max_values=1, options=get_signal_options())
     async def signal_select(self, interaction: Interaction, select: ui.Select):
@@ -439,7 +2966,7 @@ class InteractiveShellView(ui.LayoutView):
         select.options = get_signal_options(default=self.selected_signal)
     
     def get_child_process(self, depth: int = 1) -> int:
-        # Known depths from testing: 0=Term, 1=Script, 2=Shell, 3=Command
+        # Only used for shells without a PTY. Depths: 0=Shell, 1=Command
         if depth < 1:
             raise ValueError("Depth must be at least 1")
         assert self.process
@@ -456,9 +2983,7 @@ class InteractiveShellView(ui.LayoutView):
         await interaction.response.defer()
         if self.process and self.selected_signal is not None:
             try:
-                sig_value = int(self.selected_signal)
-                command_pid = self.get_child_process(depth=3)
-                psutil.Process(command_pid).send_signal(sig_value)
+                self.send_signal(int(self.selected_signal))
             except ProcessLookupError:
                 logging.warning("Process not found.")
             except:
@@ -468,9 +2993,9 @@ class InteractiveShellView(ui.LayoutView):
     async def stop_button(self, interaction: Interaction, button: ui.Button):
         await interaction.response.defer()
         try:
+            self.stopped = True
             try:
-                assert self.process
-                self.process.terminate()
+                self.terminate()
             except:
                 pass
             self.signal_select.disabled = True
@@ -479,7 +3004,7 @@ class InteractiveShellView(ui.LayoutView):
             self.send_command_button.disabled = True
             await self.set_auto_scroll()
             await self.append_log("\n[Interactive shell terminated]\n")
-            await self.render()
+            await self.renderer.flush()
         except Exception as e:
             logging.exception(e)
 
@@ -499,41 +3024,462 @@ class InteractiveShellView(ui.LayoutView):
                 cmd = str(self.command.value)
                 newline = "\r\n" if sys.platform == "win32" else "\n"
                 line = (cmd + newline).encode()
+                audit("session_input", modal_interaction.user.id, user=modal_interaction.user.name, command=cmd)
                 try:
-                    if view_ref.process and view_ref.process.stdin:
-                        view_ref.process.stdin.write(line)
-                        await view_ref.process.stdin.drain()
+                    await view_ref.write_input(line)
                 except Exception as e:
                     logging.exception(e)
                 await modal_interaction.response.defer()
 
         await interaction.response.send_modal(CommandModal())
 
-    async def interactive_session_loop_task(self):
-        if not self.process:
+    @row_4.button(label="Find", style=ButtonStyle.secondary)
+    async def find_button(self, interaction: Interaction, button: ui.Button):
+        view_ref = self
+
+        class FindModal(ui.Modal, title="Find in Log"):
+            query = ui.TextInput(
+                label="Text or /regex/",
+                style=TextStyle.short,
+                required=True,
+                placeholder="Enter the text to find...",
+            )
+
+            async def on_submit(self, modal_interaction: Interaction):
+                query = str(self.query.value)
+                try:
+                    view_ref.search = LogSearch(query)
+                except re.error as e:
+                    await modal_interaction.response.send_message(f"Invalid regular expression: {e}", ephemeral=True)
+                    return
+                try:
+                    # Start from the most recent match
+                    result = await view_ref.jump_to_match(forward=False, line=len(view_ref.log) + 1)
+                except Exception as e:
+                    logging.exception(e)
+                    await modal_interaction.response.send_message("Failed to search the log.", ephemeral=True)
+                    return
+                if result is None:
+                    await modal_interaction.response.send_message(f"No matches for `{query}`.", ephemeral=True)
+                else:
+                    await modal_interaction.response.send_message(f"Match {result[1]} of {result[2]} for `{query}`.", ephemeral=True)
+
+        await interaction.response.send_modal(FindModal())
+
+    @row_4.button(label="◀ Previous Match", style=ButtonStyle.secondary)
+    async def previous_match_button(self, interaction: Interaction, button: ui.Button):
+        await interaction.response.defer()
+        if self.search is None:
+            await interaction.followup.send("Use Find to search the log first.", ephemeral=True)
+            return
+        await self.jump_to_match(forward=False)
+
+    @row_4.button(label="Next Match ▶", style=ButtonStyle.secondary)
+    async def next_match_button(self, interaction: Interaction, button: ui.Button):
+        await interaction.response.defer()
+        if self.search is None:
+            await interaction.followup.send("Use Find to search the log first.", ephemeral=True)
+            return
+        await self.jump_to_match(forward=True)
+
+    async def finish(self):
+        assert self.process
+        await self.process.wait()
+        self.close_pty()
+        try:
+            await self.renderer.flush()
+        except Exception as e:
+            logging.exception(e)
+        stats = self.renderer.stats()
+        logging.info(
+            f"Interactive session ended. Edits sent: {stats['edits_sent']}, edits dropped: {stats['edits_dropped']}, "
+            f"render latency: {stats['latency_avg'] * 1000:.0f} ms avg, {stats['latency_max'] * 1000:.0f} ms max"
+        )
+
+
+class ShellSession:
+    """I/O state and statistics of one interactive shell, as seen by the SessionManager."""
+
+    def __init__(self, id: int, view: InteractiveShellView, owner: Union[User, Member], shell: str) -> None:
+        self.id: int = id
+        self.view: InteractiveShellView = view
+        self.owner: Union[User, Member] = owner
+        self.shell: str = shell
+        self.start_time: float = time.monotonic()
+        self.inbox: bytearray = bytearray()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.ready: bool = False
+        self.eof: bool = False
+        self.paused: bool = False
+        self.drained: asyncio.Event = asyncio.Event()
+        self.rendering: bool = False
+        self.reader_task: Optional[asyncio.Task] = None
+        self.bytes_total: int = 0
+        self.rate_start: float = self.start_time
+        self.rate_bytes: int = 0
+        self.last_rate: float = 0.0
+
+    def count_bytes(self, n: int):
+        self.bytes_total += n
+        self.rate_bytes += n
+        now = time.monotonic()
+        if now - self.rate_start >= 1:
+            self.last_rate = self.rate_bytes / (now - self.rate_start)
+            self.rate_start = now
+            self.rate_bytes = 0
+
+    def bytes_per_sec(self) -> float:
+        elapsed = time.monotonic() - self.rate_start
+        if elapsed < 1:
+            return self.last_rate
+        return self.rate_bytes / elapsed
+
+    def process_rss(self) -> int:
+        assert self.view.process
+        try:
+            process = psutil.Process(self.view.process.pid)
+            return sum(p.memory_info().rss for p in [process] + process.children(recursive=True))
+        except psutil.Error:
+            return 0
+
+
+class SessionManager:
+    """Owns all interactive shell sessions.
+
+    Output of every session is read into a per-session inbox and processed by a single task, at most
+    SESSION_QUANTUM bytes per session per turn. Renders of all sessions go through a single task that
+    shares a budget of `render_budget` edits per second between them, least recently edited first.
+    """
+
+    def __init__(self, render_budget: float = RENDER_BUDGET) -> None:
+        self.sessions: dict[int, ShellSession] = {}
+        self.next_id: int = 1
+        self.ready: collections.deque[ShellSession] = collections.deque()
+        self.input_event: Optional[asyncio.Event] = None
+        self.render_event: Optional[asyncio.Event] = None
+        self.render_budget: float = render_budget
+        self.budget_tokens: float = render_budget
+        self.budget_updated: float = time.monotonic()
+        self.tasks: list[asyncio.Task] = []
+        self.finished: collections.deque[InteractiveShellView] = collections.deque()
+
+    def ensure_started(self):
+        if self.tasks:
+            return
+        self.input_event = asyncio.Event()
+        self.render_event = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.input_loop()), asyncio.create_task(self.render_loop())]
+
+    def add(self, view: InteractiveShellView, owner: Union[User, Member], shell: str) -> ShellSession:
+        self.ensure_started()
+        session = ShellSession(self.next_id, view, owner, shell)
+        self.next_id += 1
+        self.sessions[session.id] = session
+        if view.pty_master is not None:
+            asyncio.get_running_loop().add_reader(view.pty_master, self.on_readable, session)
+        else:
+            session.reader_task = asyncio.create_task(self.read_stream(session))
+        return session
+
+    def request_render(self):
+        if self.render_event is not None:
+            self.render_event.set()
+
+    # Input
+
+    def on_readable(self, session: ShellSession):
+        assert session.view.pty_master is not None
+        try:
+            data = os.read(session.view.pty_master, MAX_READ_SIZE)
+        except BlockingIOError:
             return
+        except OSError:
+            data = b""  # EIO once the shell's side of the PTY is closed
+        self.receive(session, data)
+
+    async def read_stream(self, session: ShellSession):
+        # Shells without a PTY are read through their stdout pipe
+        assert session.view.output
         while True:
-            if self.process.returncode is not None:
-                break
-            got = False
             try:
-                if self.process.stdout:
-                    data = await asyncio.wait_for(self.process.stdout.read(4096), timeout=0.2)
-                    if data:
-                        text = data.decode(errors="ignore")
-                        text = self.sanitize_output(text)
-                        await self.append_log(text)
-                        got = True
-            except asyncio.TimeoutError:
-                pass
+                data = await session.view.output.read(MAX_READ_SIZE)
             except Exception as e:
                 logging.exception(e)
-            if got:
-                try:
-                    await self.render()
-                except Exception as e:
-                    logging.exception(e)
-            await asyncio.sleep(0.2)
+                data = b""
+            self.receive(session, data)
+            if not data:
+                return
+            if session.paused:
+                session.drained.clear()
+                await session.drained.wait()
+
+    def receive(self, session: ShellSession, data: bytes):
+        if data:
+            session.inbox += data
+            session.count_bytes(len(data))
+            if len(session.inbox) > SESSION_INBOX_LIMIT:
+                self.pause_reading(session)
+        else:
+            session.eof = True
+            self.pause_reading(session)
+        if not session.ready:
+            session.ready = True
+            self.ready.append(session)
+        assert self.input_event
+        self.input_event.set()
+
+    def pause_reading(self, session: ShellSession):
+        if session.paused:
+            return
+        session.paused = True
+        if session.view.pty_master is not None:
+            asyncio.get_running_loop().remove_reader(session.view.pty_master)
+
+    def resume_reading(self, session: ShellSession):
+        if not session.paused or session.eof:
+            return
+        session.paused = False
+        if session.view.pty_master is not None:
+            asyncio.get_running_loop().add_reader(session.view.pty_master, self.on_readable, session)
+        else:
+            session.drained.set()
+
+    async def input_loop(self):
+        assert self.input_event
+        while True:
+            await self.input_event.wait()
+            self.input_event.clear()
+            while self.ready:
+                session = self.ready.popleft()
+                chunk = bytes(session.inbox[:SESSION_QUANTUM])
+                del session.inbox[:SESSION_QUANTUM]
+                if chunk:
+                    try:
+                        await session.view.append_log(session.decoder.decode(chunk))
+                        session.view.renderer.request()
+                    except Exception as e:
+                        logging.exception(e)
+                if session.inbox:
+                    self.ready.append(session)
+                else:
+                    session.ready = False
+                    if session.eof:
+                        asyncio.create_task(self.finish(session))
+                    else:
+                        self.resume_reading(session)
+                # Let other tasks run between quanta
+                await sleep(0)
+
+    async def finish(self, session: ShellSession):
+        try:
+            await session.view.finish()
+        except Exception as e:
+            logging.exception(e)
+        self.sessions.pop(session.id, None)
+        await self.retire(session.view)
+        if not session.view.stopped:
+            NOTIFIER.notify([session.owner.id], f"Interactive {session.shell} session #{session.id} has ended.")
+
+    async def retire(self, view: InteractiveShellView):
+        # Export keeps working once a session has ended, so its spill file is kept, but only for the last
+        # FINISHED_SESSION_SPILLS finished sessions. Older ones keep the lines in memory.
+        if view.log.spill is None:
+            return
+        self.finished.append(view)
+        while len(self.finished) > FINISHED_SESSION_SPILLS:
+            await self.finished.popleft().close_log()
+
+    # Rendering
+
+    def take_budget(self) -> float:
+        # Token bucket: returns 0 if an edit may be sent now, or how long to wait for one
+        now = time.monotonic()
+        self.budget_tokens = min(self.render_budget, self.budget_tokens + (now - self.budget_updated) * self.render_budget)
+        self.budget_updated = now
+        if self.budget_tokens >= 1:
+            self.budget_tokens -= 1
+            return 0.0
+        return (1 - self.budget_tokens) / self.render_budget
+
+    async def wait_render_event(self, timeout: float):
+        assert self.render_event
+        try:
+            await asyncio.wait_for(self.render_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.render_event.clear()
+
+    async def render_loop(self):
+        assert self.render_event
+        while True:
+            await self.render_event.wait()
+            self.render_event.clear()
+            while True:
+                pending = [s for s in self.sessions.values() if s.view.renderer.dirty and not s.rendering]
+                if not pending:
+                    break
+                now = time.monotonic()
+                due = [s for s in pending if s.view.renderer.due_time() <= now]
+                if not due:
+                    await self.wait_render_event(min(s.view.renderer.due_time() for s in pending) - now)
+                    continue
+                wait = self.take_budget()
+                if wait > 0:
+                    await self.wait_render_event(wait)
+                    continue
+                session = min(due, key=lambda s: s.view.renderer.last_edit_time)
+                session.view.renderer.dirty = False
+                session.rendering = True
+                asyncio.create_task(self.render(session))
+
+    async def render(self, session: ShellSession):
+        try:
+            await session.view.renderer.render()
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            session.rendering = False
+            self.request_render()
+
+
+SESSIONS: SessionManager = SessionManager()
+
+
+class ShellProcess:
+    """A started shell: POSIX shells get a PTY, the others a stdout pipe."""
+
+    def __init__(
+        self,
+        shell: str,
+        process: asyncio.subprocess.Process,
+        pty_master: Optional[int] = None,
+        output: Optional[asyncio.StreamReader] = None,
+    ) -> None:
+        self.shell: str = shell
+        self.process: asyncio.subprocess.Process = process
+        self.pty_master: Optional[int] = pty_master
+        self.output: Optional[asyncio.StreamReader] = output
+        self.start_time: float = time.monotonic()
+
+    def is_alive(self) -> bool:
+        return self.process.returncode is None
+
+    def close(self):
+        try:
+            if self.pty_master is not None:
+                os.killpg(self.process.pid, signal.SIGHUP)
+            else:
+                self.process.terminate()
+        except ProcessLookupError:
+            pass
+        if self.pty_master is not None:
+            os.close(self.pty_master)
+            self.pty_master = None
+
+
+async def spawn_shell(shell: str) -> ShellProcess:
+    env = os.environ.copy()
+    if sys.platform == "win32" or shell not in ["sh", "bash", "zsh"]:
+        process = await asyncio.create_subprocess_shell(
+            shell,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=env,
+            preexec_fn=None if sys.platform == "win32" else EXEC_POLICY.preexec_fn(),
+        )
+        return ShellProcess(shell, process, output=process.stdout)
+    # Give POSIX shells a PTY to avoid "no job control" warnings
+    env.setdefault("TERM", "xterm")
+    master, slave = pty.openpty()
+    try:
+        # The shell leads its own session with the PTY as controlling terminal, so job control works
+        # and signals can go straight to the terminal's foreground process group
+        process = await asyncio.create_subprocess_exec(
+            shell,
+            "-i",
+            stdin=slave,
+            stdout=slave,
+            stderr=slave,
+            env=env,
+            start_new_session=True,
+            preexec_fn=prepare_pty_shell,
+        )
+    except Exception:
+        os.close(master)
+        raise
+    finally:
+        os.close(slave)
+    os.set_blocking(master, False)
+    return ShellProcess(shell, process, pty_master=master)
+
+
+class ShellPool:
+    """Keeps up to `size` idle, already started shells of each supported shell, so /shell does not wait for
+    shell startup. A pooled shell is used once and replaced in the background; idle ones older than
+    `max_idle` seconds are recycled.
+    """
+
+    def __init__(self, size: int = SHELL_POOL_SIZE, max_idle: float = SHELL_POOL_MAX_IDLE) -> None:
+        self.size: int = size
+        self.max_idle: float = max_idle
+        self.idle: dict[str, collections.deque[ShellProcess]] = {}
+        self.refilling: set[str] = set()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.size <= 0 or self.task is not None:
+            return
+        for shell in SUPPORTED_SHELLS:
+            if shutil.which(shell) is None:
+                logging.info(f"Not pooling shell {shell}: not found")
+                continue
+            self.idle[shell] = collections.deque()
+            self.schedule_refill(shell)
+        self.task = asyncio.create_task(self.recycle_loop())
+
+    def is_usable(self, shell_process: ShellProcess) -> bool:
+        return shell_process.is_alive() and time.monotonic() - shell_process.start_time < self.max_idle
+
+    async def acquire(self, shell: str) -> ShellProcess:
+        idle = self.idle.get(shell)
+        if idle is None:
+            return await spawn_shell(shell)
+        self.schedule_refill(shell)
+        while idle:
+            shell_process = idle.popleft()
+            if self.is_usable(shell_process):
+                return shell_process
+            shell_process.close()
+        return await spawn_shell(shell)
+
+    def schedule_refill(self, shell: str):
+        if shell in self.refilling:
+            return
+        self.refilling.add(shell)
+        asyncio.create_task(self.refill(shell))
+
+    async def refill(self, shell: str):
+        try:
+            idle = self.idle[shell]
+            while len(idle) < self.size:
+                idle.append(await spawn_shell(shell))
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self.refilling.discard(shell)
+
+    async def recycle_loop(self):
+        while True:
+            await sleep(self.max_idle / 2)
+            for shell, idle in list(self.idle.items()):
+                for shell_process in [p for p in idle if not self.is_usable(p)]:
+                    idle.remove(shell_process)
+                    shell_process.close()
+                self.schedule_refill(shell)
+
+
+SHELL_POOL: ShellPool = ShellPool()
 
 
 # Add describe to set argument 1 as shell to use
@@ -596,20 +3542,178 @@ async def scroll(interaction: Interaction, amount: Optional[int] = None):
         await interaction.response.send_message(f"Scroll amount set to {amount}.", ephemeral=True)
 
 
+@BOT.tree.command(name="stream", description="Toggle live streaming of command output")
+async def stream(interaction: Interaction, enabled: Optional[bool] = None):
+    global STREAM_OUTPUT
+    author = interaction.user
+    if not is_user_allowed(author):
+        await interaction.response.send_message("You are not authorized to use this command.", ephemeral=True)
+        logging.warning(f"Unauthorized access attempt by user {author} (ID: {author.id})")
+        return
+    if enabled is None:
+        STREAM_OUTPUT = DEFAULT_STREAM_OUTPUT
+        await interaction.response.send_message(f"Output streaming reset to the default ({DEFAULT_STREAM_OUTPUT}).", ephemeral=True)
+    else:
+        STREAM_OUTPUT = enabled
+        await interaction.response.send_message(f"Output streaming set to {enabled}.", ephemeral=True)
+
+
+@BOT.tree.command(name="compact", description="Toggle compact command output (collapsed repeats, changes since the last run)")
+async def compact(interaction: Interaction, enabled: Optional[bool] = None):
+    global COMPACT_OUTPUT
+    author = interaction.user
+    if not is_user_allowed(author):
+        await interaction.response.send_message("You are not authorized to use this command.", ephemeral=True)
+        logging.warning(f"Unauthorized access attempt by user {author} (ID: {author.id})")
+        return
+    if enabled is None:
+        COMPACT_OUTPUT = DEFAULT_COMPACT_OUTPUT
+        await interaction.response.send_message(f"Compact output reset to the default ({DEFAULT_COMPACT_OUTPUT}).", ephemeral=True)
+    else:
+        COMPACT_OUTPUT = enabled
+        await interaction.response.send_message(f"Compact output set to {enabled}.", ephemeral=True)
+    if not COMPACT_OUTPUT:
+        # History is only kept while compact output is on
+        OUTPUT_HISTORY.clear()
+
+
+@BOT.tree.command(name="queue", description="Show the command executor queue")
+async def queue_status(interaction: Interaction):
+    author = interaction.user
+    if not is_user_allowed(author):
+        await interaction.response.send_message("You are not authorized to use this command.", ephemeral=True)
+        logging.warning(f"Unauthorized access attempt by user {author} (ID: {author.id})")
+        return
+    stats = EXECUTOR.stats()
+    await interaction.response.send_message(
+        f"Running: {stats['in_flight']}/{stats['max_workers']}\n"
+        f"Queued: {stats['queued']} (yours: {EXECUTOR.queue_depth(author.id)}/{stats['max_queue_size']})",
+        ephemeral=True,
+    )
+
+
+@BOT.tree.command(name="metrics", description="Show event loop lag and hot path timings")
+async def metrics(interaction: Interaction):
+    author = interaction.user
+    if not is_user_allowed(author):
+        await interaction.response.send_message("You are not authorized to use this command.", ephemeral=True)
+        logging.warning(f"Unauthorized access attempt by user {author} (ID: {author.id})")
+        return
+    if not METRICS.histograms:
+        await interaction.response.send_message("No metrics recorded yet.", ephemeral=True)
+        return
+    content = "```\n" + METRICS.summary() + "\n```"
+    if len(content) <= MAX_MESSAGE_SIZE:
+        await interaction.response.send_message(content, ephemeral=True)
+    else:
+        file = File(io.BytesIO(METRICS.summary().encode()), filename="metrics.txt")
+        await interaction.response.send_message(file=file, ephemeral=True)
+
+
+@BOT.tree.command(name="stats", description="Show system CPU, memory, disk, network and load")
+@app_commands.describe(minutes=f"Minutes of history to summarize (default {DEFAULT_STATS_MINUTES})")
+async def stats(interaction: Interaction, minutes: Optional[float] = None):
+    author = interaction.user
+    if not is_user_allowed(author):
+        await interaction.response.send_message("You are not authorized to use this command.", ephemeral=True)
+        logging.warning(f"Unauthorized access attempt by user {author} (ID: {author.id})")
+        return
+    if STATS.interval <= 0:
+        await interaction.response.send_message("System stats are disabled (STATS_INTERVAL is 0).", ephemeral=True)
+        return
+    if len(STATS.buffers["cpu"]) == 0:
+        await interaction.response.send_message("No system stats sampled yet.", ephemeral=True)
+        return
+    summary = STATS.summary(minutes if minutes is not None and minutes > 0 else DEFAULT_STATS_MINUTES)
+    await interaction.response.send_message("```\n" + summary + "\n```", ephemeral=True)
+
+
+@BOT.tree.command(name="sessions", description="List active interactive shell sessions")
+async def sessions(interaction: Interaction):
+    author = interaction.user
+    if not is_user_allowed(author):
+        await interaction.response.send_message("You are not authorized to use this command.", ephemeral=True)
+        logging.warning(f"Unauthorized access attempt by user {author} (ID: {author.id})")
+        return
+    if not SESSIONS.sessions:
+        await interaction.response.send_message("No active sessions.", ephemeral=True)
+        return
+    lines = []
+    for session in SESSIONS.sessions.values():
+        uptime = time.monotonic() - session.start_time
+        lines.append(
+            f"#{session.id} {session.shell} ({session.owner.name}): up {uptime / 60:.0f} min, "
+            f"{format_bytes(session.bytes_per_sec())}/s, log {format_bytes(session.view.log.total_size())} "
+            f"({format_bytes(session.view.log.memory_size())} in memory), "
+            f"RSS {format_bytes(session.process_rss())}"
+        )
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+
+@BOT.tree.command(name="fanout", description="Run a command on several hosts in parallel")
+@app_commands.describe(command="The command to run", hosts="Comma-separated host names (all hosts by default)")
+async def fanout(interaction: Interaction, command: str, hosts: Optional[str] = None):
+    author = interaction.user
+    if not is_user_allowed(author):
+        await interaction.response.send_message("You are not authorized to use this command.", ephemeral=True)
+        logging.warning(f"Unauthorized access attempt by user {author} (ID: {author.id})")
+        return
+    if hosts is None or hosts.strip() == "all":
+        names = AGENTS.names()
+    else:
+        names = list(dict.fromkeys(name.strip() for name in hosts.split(",") if name.strip()))
+    unknown = [name for name in names if name not in AGENTS.names()]
+    if unknown or not names:
+        await interaction.response.send_message(
+            f"Unknown hosts: {', '.join(unknown)}. Available hosts: {', '.join(AGENTS.names())}", ephemeral=True
+        )
+        return
+    await interaction.response.defer(thinking=True)
+    logging.info(f"Executing command on {', '.join(names)} sent by user {author.name} (ID: {author.id}): {command}")
+    start = time.monotonic()
+    results = await AGENTS.fan_out(names, author.id, command, CMD_TIMEOUT)
+    elapsed = time.monotonic() - start
+    for name, result in results.items():
+        audit_command(author.id, author.name, command, start, result, host=name)
+    # Hosts with identical results are listed together
+    groups: dict[str, list[str]] = {}
+    for name, result in results.items():
+        if isinstance(result, subprocess.CompletedProcess):
+            body = format_result(result)
+            if COMPACT_OUTPUT:
+                body = collapse_repeats(body)
+        else:
+            body = f"[ERROR] {str(result) or type(result).__name__}"
+        groups.setdefault(body, []).append(name)
+    summary = f"Ran on {len(names)} hosts in {elapsed:.1f}s, {len(groups)} distinct results: {command}"
+    text = "\n\n".join(f"[HOSTS: {', '.join(group)}]\n{body.rstrip()}" for body, group in groups.items())
+    prefix: str = "```sh\n"
+    suffix: str = "\n```"
+    if len(summary + "\n" + prefix + text + suffix) <= MAX_MESSAGE_SIZE:
+        await interaction.followup.send(summary + "\n" + prefix + text + suffix)
+        return
+    files = await build_attachments(text, f"fanout_{interaction.id}.txt")
+    await interaction.followup.send(content=summary, file=files[0])
+    for file in files[1:]:
+        await interaction.followup.send(file=file)
+
+
 # -----------------------------Run and Connect Bot------------------------------
 
 if __name__ == "__main__":
     makedirs(DATA_PATH, exist_ok=True)
-    makedirs(TEMP_PATH, exist_ok=True)
-    logging_handler = TimedRotatingFileHandler(filename=LOG_PATH, when="D", interval=30)
-    logging.basicConfig(
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%d-%b-%y %H:%M:%S",
-        level=logging.INFO,
-        handlers=[logging_handler],
-    )
+    # Spilled session logs of a previous run can no longer be viewed
+    shutil.rmtree(SESSIONS_PATH, ignore_errors=True)
+    setup_logging()
 
     load_dotenv()
+    if "--agent" in sys.argv[1:]:
+        load_environ(agent_mode=True)
+        try:
+            asyncio.run(run_agent())
+        except KeyboardInterrupt:
+            pass
+        exit(0)
     load_environ()
     try:
         BOT.run(TOKEN)